@@ -0,0 +1,79 @@
+# Compare sequential and thread pool decoding of TMX layers.
+#
+#   python layer-benchmark.py [layers] [size] [threads]
+#
+# Writes a synthetic map with many large zlib compressed layers (and the
+# same again uncompressed) to a temporary directory and times
+# TileMap.parsexml() on it with and without a thread pool. Only the
+# compressed layers go to the pool, and only inflating them runs in
+# parallel, so expect a speedup just for those and only on several cores.
+
+import os
+import sys
+import zlib
+import time
+import array
+import base64
+import random
+import shutil
+import tempfile
+
+import tmx
+
+
+def write_map(path, layers, size, compression):
+    random.seed(1)
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<map version="1.0" orientation="orthogonal" width="%d" '
+                'height="%d" tilewidth="21" tileheight="21">\n' % (size, size))
+        f.write(' <tileset firstgid="1" name="tiles" tilewidth="21" '
+                'tileheight="21"/>\n')
+        for n in range(layers):
+            gids = array.array('I', [random.choice((0, 0, 0, 1, 2, 3))
+                                     for i in range(size * size)])
+            if sys.byteorder == 'big':
+                gids.byteswap()
+            raw = gids.tobytes() if hasattr(gids, 'tobytes') else gids.tostring()
+            if compression:
+                raw = zlib.compress(raw)
+                attrs = 'encoding="base64" compression="zlib"'
+            else:
+                attrs = 'encoding="base64"'
+            f.write(' <layer name="layer%d" width="%d" height="%d">\n'
+                    '  <data %s>\n   %s\n  </data>\n </layer>\n' % (
+                        n, size, size, attrs,
+                        base64.b64encode(raw).decode('ascii')))
+        f.write('</map>\n')
+
+
+def best_of(runs, filename, threads):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        tmx.TileMap.parsexml(filename, threads=threads)
+        took = time.time() - start
+        if best is None or took < best:
+            best = took
+    return best
+
+
+def main(layers=32, size=256, threads=4):
+    directory = tempfile.mkdtemp()
+    try:
+        for compression in ('zlib', None):
+            filename = os.path.join(directory, 'synthetic.tmx')
+            write_map(filename, layers, size, compression)
+            sequential = best_of(3, filename, 0)
+            parallel = best_of(3, filename, threads)
+            print('%d layers of %dx%d, %s: sequential %.3fs, %d threads '
+                  '%.3fs (%.2fx)' % (layers, size, size,
+                                     compression or 'uncompressed',
+                                     sequential, threads, parallel,
+                                     sequential / parallel))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
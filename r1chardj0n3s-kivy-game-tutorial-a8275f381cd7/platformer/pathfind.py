@@ -0,0 +1,271 @@
+# Path finding over "Tiled" TMX map layers
+# This code is placed in the Public Domain.
+
+'''A* path finding over the cells of a tmx.Layer.
+
+A NavGrid holds which cells of a Layer may be moved through (those without
+the "blocker" property, by default) as a bytearray compiled from the
+Layer's flags, and caches the paths found: every path found to a goal also
+gives the path to that goal from each cell along it, so later searches
+from those cells are answered straight away. The grid and the cache are
+refreshed when the Layer's cells change.
+
+Moves are to the four neighbours of a cell, as given by Layer.neighbors().
+
+Searches may be run to completion with NavGrid.path() or spread over
+frames with a Pathfinder, which runs all the searches asked of it for a
+fixed amount of time each frame:
+
+    pathfinder = pathfind.Pathfinder(pathfind.NavGrid(layer))
+    Clock.schedule_interval(pathfinder.update, 1 / 60.)
+    ...
+    pathfinder.find((x1, y1), (x2, y2), enemy.on_path)
+'''
+
+import time
+import heapq
+
+
+class NavGrid(object):
+    '''The cells of a tmx.Layer which may be moved through: those without
+    the indicated property set.
+
+        blocked - a bytearray in row order, 1 for the cells which may not
+                  be moved through
+        generation - a count of the changes to blocked
+    '''
+
+    def __init__(self, layer, propname='blocker'):
+        self.layer = layer
+        self.propname = propname
+        self.width = layer.width
+        self.height = layer.height
+        self.blocked = None
+        self.generation = 0
+        self._version = None
+        self.refresh()
+
+    def __repr__(self):
+        return '<NavGrid for %r>' % self.layer
+
+    def refresh(self):
+        '''Bring the grid up to date with the Layer's cells.
+
+        Return whether the cells which may be moved through have changed
+        (in which case the cached paths are dropped.)
+        '''
+        layer = self.layer
+        if self._version == layer.version:
+            return False
+        self._version = layer.version
+        bit = layer.flag_bits.get(self.propname)
+        if bit and layer.flags is not None:
+            blocked = layer.flags.translate(_bit_table(bit))
+        else:
+            blocked = bytearray(layer.property_mask(self.propname))
+        if blocked == self.blocked:
+            return False
+        self.blocked = blocked
+        self.generation += 1
+        # goal -> {cell: next cell along the path to the goal}
+        self._next = {}
+        # goal -> cells known not to reach the goal
+        self._unreachable = {}
+        return True
+
+    def walkable(self, pos):
+        '''Return whether the cell at (x, y) may be moved through.
+        '''
+        x, y = pos
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return False
+        return not self.blocked[x + y * self.width]
+
+    def cached(self, start, goal):
+        '''Return the path (a list of (x, y) cells from start to goal) if
+        it's known, None if the goal is known not to be reachable from the
+        start or False if neither is known yet.
+        '''
+        self.refresh()
+        w = self.width
+        s, g = start[0] + start[1] * w, goal[0] + goal[1] * w
+        if not (self.walkable(start) and self.walkable(goal)):
+            return None
+        if s == g:
+            return [tuple(start)]
+        if s in self._unreachable.get(g, ()):
+            return None
+        following = self._next.get(g)
+        if following is None or s not in following:
+            return False
+        path = [s]
+        while path[-1] != g:
+            path.append(following[path[-1]])
+        return [(k % w, k // w) for k in path]
+
+    def path(self, start, goal):
+        '''Find the shortest path from the start (x, y) cell to the goal.
+
+        Return a list of (x, y) cells from start to goal, or None if there
+        is no path.
+        '''
+        search = Search(self, start, goal)
+        while not search.step(1024):
+            pass
+        return search.path
+
+    def _found(self, goal, path):
+        # remember the way to the goal from every cell along the path
+        following = self._next.setdefault(goal, {})
+        for k, next in zip(path, path[1:]):
+            following[k] = next
+
+    def _failed(self, goal, seen):
+        self._unreachable.setdefault(goal, set()).update(seen)
+
+
+def _bit_table(bit, tables={}):
+    # translation table from flags bytes to 1 if the bit is set, else 0
+    table = tables.get(bit)
+    if table is None:
+        table = tables[bit] = bytes(bytearray(1 if n & bit else 0
+                                              for n in range(256)))
+    return table
+
+
+class Search(object):
+    '''An A* search over a NavGrid, run a number of cells at a time with
+    step(). The search starts again if the NavGrid changes part way.
+
+        done - whether the search has finished
+        path - the list of (x, y) cells from start to goal once done, or
+               None if there is no path
+    '''
+
+    def __init__(self, grid, start, goal):
+        self.grid = grid
+        self.start = tuple(start)
+        self.goal = tuple(goal)
+        self._begin()
+
+    def _begin(self):
+        grid, start, goal = self.grid, self.start, self.goal
+        self.path = grid.cached(start, goal)
+        self.done = self.path is not False
+        if self.done:
+            return
+        self.path = None
+        self._generation = grid.generation
+        w = grid.width
+        s = start[0] + start[1] * w
+        self._goal = goal[0] + goal[1] * w
+        self._came = {s: -1}
+        self._cost = {s: 0}
+        self._open = [(self._estimate(s), 0, s)]
+
+    def __repr__(self):
+        return '<Search %s to %s>' % (self.start, self.goal)
+
+    def _estimate(self, k):
+        w = self.grid.width
+        return abs(k % w - self.goal[0]) + abs(k // w - self.goal[1])
+
+    def step(self, count):
+        '''Look at up to count more cells.
+
+        Return whether the search is done.
+        '''
+        if self.done:
+            return True
+        grid = self.grid
+        grid.refresh()
+        if grid.generation != self._generation:
+            # the cells changed under us
+            self._begin()
+            if self.done:
+                return True
+        blocked, w = grid.blocked, grid.width
+        size = w * grid.height
+        heap, cost, came = self._open, self._cost, self._came
+        goal, estimate = self._goal, self._estimate
+        while count > 0 and heap:
+            count -= 1
+            f, g, k = heapq.heappop(heap)
+            # g is pushed negated so ties favour the furthest along
+            g = -g
+            if g > cost[k]:
+                continue
+            if k == goal:
+                path = [k]
+                while came[path[-1]] != -1:
+                    path.append(came[path[-1]])
+                path.reverse()
+                grid._found(goal, path)
+                self.path = [(k % w, k // w) for k in path]
+                self.done = True
+                return True
+            g += 1
+            x = k % w
+            for n in (k + 1 if x < w - 1 else -1, k - 1 if x else -1,
+                      k + w, k - w):
+                if not 0 <= n < size or blocked[n]:
+                    continue
+                if g < cost.get(n, size):
+                    cost[n] = g
+                    came[n] = k
+                    heapq.heappush(heap, (g + estimate(n), -g, n))
+        if not heap:
+            grid._failed(goal, came)
+            self.done = True
+        return self.done
+
+
+class Pathfinder(object):
+    '''Runs any number of searches over a NavGrid, for budget seconds
+    each time update() is called (eg. every frame by the Kivy Clock).
+
+    The searches take turns, count cells at a time. A search whose path is
+    already cached by the NavGrid finishes as soon as it's asked for.
+    '''
+
+    def __init__(self, grid, budget=.002, count=64):
+        self.grid = grid
+        self.budget = budget
+        self.count = count
+        self.searches = []
+
+    def find(self, start, goal, on_path=None):
+        '''Search for the path from the start (x, y) cell to the goal.
+
+        on_path(path) is called with the path (see Search) once it's found,
+        which may be straight away.
+
+        Return the Search.
+        '''
+        search = Search(self.grid, start, goal)
+        search.on_path = on_path
+        if search.done:
+            self._finish(search)
+        else:
+            self.searches.append(search)
+        return search
+
+    def cancel(self, search):
+        '''Stop the search if it's still under way.
+        '''
+        if search in self.searches:
+            self.searches.remove(search)
+
+    def _finish(self, search):
+        if search.on_path is not None:
+            search.on_path(search.path)
+
+    def update(self, *ignore):
+        '''Run the searches under way for up to budget seconds.
+        '''
+        end = time.time() + self.budget
+        while self.searches and time.time() < end:
+            for search in list(self.searches):
+                if search.step(self.count):
+                    self.searches.remove(search)
+                    self._finish(search)
@@ -36,8 +36,6 @@ class Player(Sprite):
         self.dy = 0
 
     def update(self):
-        last = Rect(*(self.pos + self.size))
-
         dx = 0
         if keys.get(Keyboard.keycodes['left']):
             dx -= 2 * params.scale
@@ -49,22 +47,13 @@ class Player(Sprite):
 
         self.dy = max(-8 * params.scale, self.dy - .5 * params.scale)
 
-        self.x += dx
-        self.y += self.dy
-
         new = Rect(*(self.pos + self.size))
-        for cell in self.map.layers['objects'].collide(new, 'blocker'):
-            blocker = cell['blocker']
-            if 'l' in blocker and last.right <= cell.left and new.right > cell.left:
-                new.right = cell.left
-            if 'r' in blocker and last.left >= cell.right and new.left < cell.right:
-                new.left = cell.right
-            if 't' in blocker and last.bottom >= cell.top and new.bottom < cell.top:
+        blockers = self.map.merged['blocker']
+        contacts = blockers.slide(new, dx, self.dy, 'blocker')[0]
+        for (nx, ny), cell in contacts:
+            if ny > 0:
                 self.resting = True
-                new.bottom = cell.top
-                self.dy = 0
-            if 'b' in blocker and last.top <= cell.bottom and new.top > cell.bottom:
-                new.top = cell.bottom
+            if ny:
                 self.dy = 0
         self.pos = new.bottomleft
 
@@ -116,6 +105,9 @@ class PlatformerApp(App):
         params.init()
         return Game()
 
+    def on_stop(self):
+        self.root.map.release()
+
 
 class params(object):
     def init(self):
@@ -6,19 +6,127 @@
 
 import os
 import sys
-import struct
+import time
+import zlib
+import array
+import base64
+import heapq
+import weakref
+import threading
+import collections
 from xml.etree import ElementTree
 from rect import Rect
+import tmxcache
 
 import kivy
 
 kivy.require('1.8.0')
 
 from kivy.uix.image import Image
-from kivy.graphics import Rectangle, Color
+from kivy.graphics import Rectangle, Color, InstructionGroup, Mesh
+from kivy.graphics import Fbo, ClearColor, ClearBuffers
 from kivy.uix.widget import Widget
 from kivy.graphics import Translate, PushMatrix, PopMatrix
 from kivy.utils import get_color_from_hex
+from kivy.clock import Clock, mainthread
+
+
+def parse_properties(tag):
+    '''Return the <properties> of the tag as a dict.
+    '''
+    properties = {}
+    props = tag.find('properties')
+    if props is None:
+        return properties
+    for c in props.findall('property'):
+        # store additional properties.
+        name = c.attrib['name']
+        value = c.attrib['value']
+
+        # TODO hax
+        if value.isdigit():
+            value = int(value)
+        properties[name] = value
+    return properties
+
+
+# Tiled stores tile flipping in the top three bits of each gid
+FLIPPED_HORIZONTALLY = 0x80000000
+FLIPPED_VERTICALLY = 0x40000000
+FLIPPED_DIAGONALLY = 0x20000000
+GID_MASK = 0x1fffffff
+
+# byte translation which clears the flip bits from the high byte of a gid
+_unflip = bytes(bytearray(i & (GID_MASK >> 24) for i in range(256)))
+
+
+def decode_gids(data, tag=None):
+    '''Decode the gids from a layer's <data> tag, in row order. For
+    infinite maps pass the <chunk> to decode as tag.
+
+    Handles all the TMX layer encodings: csv, base64 (uncompressed, zlib or
+    gzip compressed) and plain <tile> tags. The gids are returned as an
+    unsigned int array with the flip bits masked off.
+
+    The flip bits are cleared from the raw little-endian gid bytes in one
+    pass (by translating every fourth byte) rather than gid by gid.
+    '''
+    return _decode(*_payload(data, tag))
+
+
+def decode_gids_async(pool, data, tag=None):
+    '''Start decoding the gids from a layer's <data> tag (see decode_gids())
+    on the thread pool, if they're zlib or gzip compressed; inflating is
+    the only part of decoding which releases the GIL, so other encodings
+    are decoded straight away.
+
+    Returns a function which waits for and returns the gids.
+    '''
+    payload = _payload(data, tag)
+    if payload[1]:
+        return pool.apply_async(_decode, payload).get
+    gids = _decode(*payload)
+    return lambda: gids
+
+
+def _payload(data, tag=None):
+    # pull the encoded gids out of the XML so they may be decoded elsewhere
+    if tag is None:
+        tag = data
+    encoding = data.get('encoding')
+    if encoding is None:
+        content = [tile.get('gid', 0) for tile in tag.findall('tile')]
+    else:
+        content = tag.text
+    return encoding, data.get('compression'), content
+
+
+def _decode(encoding, compression, content):
+    if encoding == 'base64':
+        raw = base64.b64decode(content.strip())
+        if compression == 'zlib':
+            raw = zlib.decompress(raw)
+        elif compression == 'gzip':
+            raw = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+        elif compression:
+            raise ValueError('unsupported layer compression %r' % compression)
+    else:
+        if encoding == 'csv':
+            gids = array.array('I', [int(gid) for gid in content.split(',')])
+        elif encoding is None:
+            gids = array.array('I', [int(gid) for gid in content])
+        else:
+            raise ValueError('unsupported layer encoding %r' % encoding)
+        if sys.byteorder == 'big':
+            gids.byteswap()
+        raw = gids.tobytes() if hasattr(gids, 'tobytes') else gids.tostring()
+
+    raw = bytearray(raw)
+    raw[3::4] = raw[3::4].translate(_unflip)
+    gids = array.array('I', bytes(raw))
+    if sys.byteorder == 'big':
+        gids.byteswap()
+    return gids
 
 
 class Tile(object):
@@ -37,18 +145,7 @@ class Tile(object):
         self.scale = tileset.scale
 
     def loadxml(self, tag):
-        props = tag.find('properties')
-        if props is None:
-            return
-        for c in props.findall('property'):
-            # store additional properties.
-            name = c.attrib['name']
-            value = c.attrib['value']
-
-            # TODO hax
-            if value.isdigit():
-                value = int(value)
-            self.properties[name] = value
+        self.properties.update(parse_properties(tag))
 
     def __repr__(self):
         return '<Tile %d>' % self.gid
@@ -57,8 +154,27 @@ class Tile(object):
 class Tileset(object):
     '''
     Tile sets are NOT SCALED, but do record the scaled tile dimensions.
+
+    Tiles are only created when first looked up with get_tile(). Until then
+    a tile is just an entry in the tile_properties dict (keyed off gid) and
+    in the uvs array which holds the (u1, v1, u2, v2) texture coordinates
+    of each tile in gid order.
+
+    Each TileMap has its own Tilesets (and Tiles), but the texture of the
+    tileset image and its tile regions and uvs are shared by all the maps
+    using the same image, through the tileset_cache; source is that
+    TilesetImage.
+
+    A Tileset packed into a TileAtlas draws its tiles from the atlas
+    texture; positions then holds the (x, y) of each tile in it.
+
+    The animations dict holds the frames of the animated tiles, keyed off
+    gid, as a list of (frame gid, duration in seconds); see TileAnimator.
     '''
 
+    # parsed external tilesets, keyed off (path, modification time)
+    _tsx = {}
+
     def __init__(self, name, tile_width, tile_height, firstgid, spacing=0, margin=0, scale=1):
         self.name = name
         self.tile_width = tile_width
@@ -66,72 +182,723 @@ class Tileset(object):
         self.firstgid = firstgid
         self.spacing = spacing
         self.margin = margin
-        self.tiles = []
+        self.texture = None
+        self.image = None
+        self.source = None
+        self.positions = None
+        self.columns = self.tile_count = 0
+        self.uvs = array.array('f')
+        self.tiles = {}
+        self.tile_properties = {}
+        self.animations = {}
         self.properties = {}
         self.scale = scale
         self.scaled_tile_width = self.tile_width * self.scale
         self.scaled_tile_height = self.tile_height * self.scale
 
     @classmethod
-    def fromxml(cls, tag, tilemap, firstgid=None):
+    def parsexml(cls, tag, base_path, firstgid=None):
+        '''Parse a <tileset> tag into a plain dict describing the tileset
+        (see fromdata()). External tilesets are read from their .tsx file.
+        '''
         if 'source' in tag.attrib:
             firstgid = int(tag.attrib['firstgid'])
             path = tag.attrib['source']
             if not os.path.exists(path):
-                path = os.path.join(tilemap.file_path, path)
-            with open(path) as f:
-                tileset = ElementTree.fromstring(f.read())
-            return cls.fromxml(tileset, firstgid)
+                path = os.path.join(base_path, path)
+            key = (os.path.abspath(path), os.path.getmtime(path))
+            data = cls._tsx.get(key)
+            if data is None:
+                with open(path) as f:
+                    tileset = ElementTree.fromstring(f.read())
+                data = cls._tsx[key] = cls.parsexml(tileset,
+                                                    os.path.dirname(path), 0)
+            return dict(data, firstgid=firstgid, source=path)
 
-        name = tag.attrib['name']
         if firstgid is None:
             firstgid = int(tag.attrib['firstgid'])
-        tile_width = int(tag.attrib['tilewidth'])
-        tile_height = int(tag.attrib['tileheight'])
-        spacing = int(tag.get('spacing', 0))
-        margin = int(tag.get('margin', 0))
-
-        tileset = cls(name, tile_width, tile_height, firstgid,
-                      spacing, margin, tilemap.scale)
-
-        for c in tag.getchildren():
+        data = dict(name=tag.attrib['name'], firstgid=firstgid,
+                    tilewidth=int(tag.attrib['tilewidth']),
+                    tileheight=int(tag.attrib['tileheight']),
+                    spacing=int(tag.get('spacing', 0)),
+                    margin=int(tag.get('margin', 0)),
+                    image=None, source=None, tiles=[], animations=[])
+        for c in tag:
             if c.tag == "image":
-                # create a tileset
-                tileset.add_image(tilemap.file_path, c.attrib['source'])
+                image = c.attrib['source']
+                if not os.path.exists(image):
+                    image = os.path.join(base_path, image)
+                data['image'] = image
             elif c.tag == 'tile':
-                gid = tileset.firstgid + int(c.attrib['id'])
-                tileset.get_tile(gid).loadxml(c)
+                data['tiles'].append([int(c.attrib['id']),
+                                      parse_properties(c)])
+                animation = c.find('animation')
+                if animation is not None:
+                    # frames of [tile id, duration in milliseconds]
+                    data['animations'].append([int(c.attrib['id']), [
+                        [int(frame.attrib['tileid']),
+                         int(frame.attrib['duration'])]
+                        for frame in animation.findall('frame')]])
+        return data
+
+    @classmethod
+    def fromdata(cls, data, tilemap):
+        '''Create a Tileset from the dict produced by parsexml().
+        '''
+        tileset = cls(data['name'], data['tilewidth'], data['tileheight'],
+                      data['firstgid'], data['spacing'], data['margin'],
+                      tilemap.scale)
+        if data['image']:
+            # create a tileset
+            tileset.add_image(tilemap.file_path, data['image'])
+        for id, properties in data['tiles']:
+            gid = tileset.firstgid + id
+            tileset.tile_properties.setdefault(gid, {}).update(properties)
+        for id, frames in data['animations']:
+            tileset.animations[tileset.firstgid + id] = [
+                (tileset.firstgid + frame, duration / 1000.)
+                for frame, duration in frames]
         return tileset
 
+    @classmethod
+    def fromxml(cls, tag, tilemap, firstgid=None):
+        return cls.fromdata(cls.parsexml(tag, tilemap.file_path, firstgid),
+                            tilemap)
+
     def add_image(self, base_path, file):
         if not os.path.exists(file):
             file = os.path.join(base_path, file)
+        self.source = tileset_cache.acquire(file, self.tile_width,
+                                            self.tile_height, self.spacing,
+                                            self.margin)
+        self.image = file
+        self.texture = self.source.texture
+        self.columns = self.source.columns
+        self.tile_count = self.source.tile_count
+        self.uvs = self.source.uvs
+
+    def release(self):
+        '''Release the tileset image back to the tileset_cache.
+        '''
+        if self.source is not None:
+            tileset_cache.release(self.source)
+            self.source = None
+
+    def use_atlas(self, texture, positions):
+        '''Draw the tiles from the (atlas) texture, at the (x, y) positions
+        given for each tile in turn. Tiles already created are updated.
+        '''
+        self.texture = texture
+        self.positions = positions
+        self._set_uvs()
+        for gid, tile in self.tiles.items():
+            x, y = self.region(gid - self.firstgid)
+            tile.texture = texture.get_region(x, y, self.tile_width,
+                                              self.tile_height)
+
+    def _set_uvs(self):
+        w, h = float(self.texture.width), float(self.texture.height)
+        uvs = []
+        for index in xrange(self.tile_count):
+            x, y = self.region(index)
+            uvs.extend((x / w, y / h, (x + self.tile_width) / w,
+                        (y + self.tile_height) / h))
+        self.uvs = array.array('f', uvs)
+
+    def region(self, index):
+        '''Return the pixel position in the texture of the bottom-left
+        corner of the tile with the given index (gid - firstgid.)
+        '''
+        if self.positions is not None:
+            return self.positions[index * 2], self.positions[index * 2 + 1]
+        return self.source.region(index)
+
+    def get_tile(self, gid):
+        tile = self.tiles.get(gid)
+        if tile is not None:
+            return tile
+        index = gid - self.firstgid
+        if not 0 <= index < self.tile_count:
+            raise IndexError(gid)
+        if self.positions is None:
+            texture = self.source.get_region(index)
+        else:
+            x, y = self.region(index)
+            texture = self.texture.get_region(x, y, self.tile_width,
+                                              self.tile_height)
+        tile = self.tiles[gid] = Tile(gid, texture, self)
+        tile.properties = self.tile_properties.setdefault(gid, tile.properties)
+        return tile
+
+
+class TileAtlas(object):
+    '''The tiles of a number of Tilesets packed into as few textures (pages
+    of at most max_size pixels square) as possible, so that a map using
+    several Tilesets may be drawn with a single texture.
+
+    Each tile is surrounded by padding pixels copied from its edges so that
+    neighbouring tiles don't bleed into it when drawn at fractional
+    positions or scales. All of a Tileset's tiles are on the same page; a
+    Tileset too large for a page is left as it is.
+
+    The pages are drawn on the GPU through an Fbo each, found in group,
+    which should be drawn in a canvas so that the pages are drawn again if
+    the GL context is lost. The layout of the pages is kept next to the
+    map (see tmxcache.load_atlas()).
+
+    Packing changes the Tilesets (and their Tiles) to draw from the atlas.
+    These belong to the one map; other maps using the same tileset images
+    keep drawing from the images.
+
+        textures - the texture of each page
+    '''
+
+    padding = 2
+    max_size = 2048
+
+    def __init__(self, tilesets, filename=None):
+        self.tilesets = [tileset for tileset in tilesets
+                         if tileset.texture is not None and tileset.tile_count]
+        sizes = [(tileset.tile_width, tileset.tile_height, tileset.tile_count)
+                 for tileset in self.tilesets]
+        key = [[tileset.image] + list(size)
+               for tileset, size in zip(self.tilesets, sizes)]
+        key = [key, self.padding, self.max_size]
+        layout = filename and tmxcache.load_atlas(filename, key)
+        if not layout:
+            layout = self.layout(sizes, self.padding, self.max_size)
+            if filename:
+                tmxcache.save_atlas(filename, key, layout,
+                                    [tileset.image for tileset in self.tilesets])
+        pages, places = layout['pages'], layout['places']
+
+        self.group = InstructionGroup()
+        fbos = []
+        for w, h in pages:
+            fbo = Fbo(size=(w, h))
+            with fbo:
+                ClearColor(0, 0, 0, 0)
+                ClearBuffers()
+            fbos.append(fbo)
+        for tileset, place in zip(self.tilesets, places):
+            if place is not None:
+                self._draw(fbos[place[0]], tileset, place[1:])
+        self.textures = []
+        for fbo in fbos:
+            fbo.draw()
+            fbo.texture.mag_filter = 'nearest'
+            self.group.add(fbo)
+            self.textures.append(fbo.texture)
+        for tileset, place in zip(self.tilesets, places):
+            if place is not None:
+                tileset.use_atlas(self.textures[place[0]],
+                                  array.array('i', place[1:]))
+
+    def __repr__(self):
+        return '<TileAtlas of %d pages>' % len(self.textures)
+
+    def _draw(self, fbo, tileset, positions):
+        # copy each tile and its edges (stretched over the padding)
+        p, texture = self.padding, tileset.texture
+        tw, th = tileset.tile_width, tileset.tile_height
+
+        def pieces(size):
+            # (source offset, source size, offset, size) along an axis
+            if not p:
+                return [(0, size, 0, size)]
+            return [(0, 1, -p, p), (0, size, 0, size), (size - 1, 1, size, p)]
+
+        with fbo:
+            for index in xrange(tileset.tile_count):
+                sx, sy = tileset.region(index)
+                x, y = positions[index * 2], positions[index * 2 + 1]
+                for u, uw, dx, w in pieces(tw):
+                    for v, vh, dy, h in pieces(th):
+                        Rectangle(pos=(x + dx, y + dy), size=(w, h),
+                                  texture=texture.get_region(sx + u, sy + v,
+                                                             uw, vh))
+
+    @staticmethod
+    def layout(sizes, padding, max_size):
+        '''Lay out tiles of the (tile width, tile height, tile count) sizes
+        of some Tilesets, with padding around each, in rows on pages.
+
+        Return a dict holding the [width, height] of the "pages" and the
+        "places" of each Tileset's tiles: [page, x1, y1, x2, y2, ...] for
+        each tile in turn, or None for a Tileset too large for a page.
+        '''
+        cells = [(tw + padding * 2, th + padding * 2) for tw, th, count in sizes]
+        area = sum(cw * ch * count
+                   for (cw, ch), (tw, th, count) in zip(cells, sizes))
+        width = min(max_size,
+                    max([int(area ** .5) + 1] + [cw for cw, ch in cells]))
+        # each page's [x, y, row height, width used]
+        pages = []
+        places = [None] * len(sizes)
+        # taller tiles first so the rows waste less space
+        for n in sorted(range(len(sizes)), key=lambda n: -cells[n][1]):
+            (cw, ch), count = cells[n], sizes[n][2]
+            for page, state in enumerate(pages + [[0, 0, 0, 0]]):
+                state = list(state)
+                spots = _shelve(state, width, max_size, cw, ch, count)
+                if spots is not None:
+                    break
+            else:
+                continue
+            if page == len(pages):
+                pages.append(state)
+            pages[page] = state
+            place = places[n] = [page]
+            for x, y in spots:
+                place.extend((x + padding, y + padding))
+        return dict(pages=[[used, y + row] for x, y, row, used in pages],
+                    places=places)
+
+
+def _shelve(state, width, height, cw, ch, count):
+    # place count cells of cw by ch in rows on a page of width by height
+    # whose [x, y, row height, width used] is state; return their (x, y)
+    # or None if they don't all fit
+    x, y, row, used = state
+    spots = []
+    for n in xrange(count):
+        if x + cw > width:
+            x, y, row = 0, y + row, 0
+        if cw > width or y + ch > height:
+            return None
+        spots.append((x, y))
+        x += cw
+        row = max(row, ch)
+        used = max(used, x)
+    state[:] = [x, y, row, used]
+    return spots
+
+
+class Tilesets(dict):
+    '''All the Tiles of a map keyed off gid; they're fetched from their
+    Tileset as they're first looked up.
+    '''
+
+    def __init__(self):
+        self.sets = []
+
+    def add(self, tileset):
+        self.sets.append(tileset)
+
+    def tileset_for(self, gid):
+        '''Return the Tileset holding the gid, or None.
+        '''
+        for tileset in self.sets:
+            if tileset.firstgid <= gid < tileset.firstgid + tileset.tile_count:
+                return tileset
+
+    def __missing__(self, gid):
+        tileset = self.tileset_for(gid)
+        if tileset is None:
+            raise KeyError(gid)
+        tile = self[gid] = tileset.get_tile(gid)
+        return tile
+
+    def __contains__(self, gid):
+        return dict.__contains__(self, gid) or self.tileset_for(gid) is not None
+
+    def get(self, gid, default=None):
+        if gid not in self:
+            return default
+        return self[gid]
+
+    def flags(self, flag_bits):
+        '''Return a dict of the flags of the gids whose tiles have any of
+        the properties named in flag_bits (a dict of name to bit.)
+        '''
+        table = {}
+        for tileset in self.sets:
+            for gid, properties in tileset.tile_properties.items():
+                flags = 0
+                for name in properties:
+                    flags |= flag_bits.get(name, 0)
+                if flags:
+                    table[gid] = flags
+        return table
+
+
+class TileAnimator(object):
+    '''Plays the animated tiles of a map's Tilesets, all off the one clock:
+    update() is called with the time passed (TileMapWidget does so every
+    frame.)
+
+    Each animated gid shows a single frame at a time wherever it's drawn,
+    so moving the animations on costs one update per animated gid rather
+    than one per cell: the gid's Tile (which, like the Tilesets, belongs
+    to the one map) is given the frame's texture, and update() returns the
+    gids whose frame changed for the views drawing them to follow.
+
+        animations - the [(frame gid, duration in seconds), ...] of each
+                     animated gid
+        frames - the gid of the frame each animated gid is showing
+    '''
+
+    def __init__(self, tilesets):
+        self.tilesets = tilesets
+        self.animations = {}
+        for tileset in tilesets.sets:
+            self.animations.update(tileset.animations)
+        self._periods = {}
+        for gid, frames in list(self.animations.items()):
+            period = sum(duration for frame, duration in frames)
+            if period > 0:
+                self._periods[gid] = period
+            else:
+                del self.animations[gid]
+        self.time = 0
+        self.frames = {}
+        self._textures = {}
+        for gid, frames in self.animations.items():
+            self._show(gid, frames[0][0])
+
+    def __repr__(self):
+        return '<TileAnimator of %d gids>' % len(self.animations)
+
+    def _show(self, gid, frame):
+        self.frames[gid] = frame
+        texture = self._textures.get(frame)
+        if texture is None:
+            tileset = self.tilesets.tileset_for(frame)
+            x, y = tileset.region(frame - tileset.firstgid)
+            texture = self._textures[frame] = tileset.texture.get_region(
+                x, y, tileset.tile_width, tileset.tile_height)
+        self.tilesets[gid].texture = texture
+
+    def update(self, dt):
+        '''Move the animations on by dt seconds.
+
+        Return a dict of the gids whose frame changed, to their new frame.
+        '''
+        self.time += dt
+        changed = {}
+        for gid, frames in self.animations.items():
+            t = self.time % self._periods[gid]
+            for frame, duration in frames:
+                if t < duration:
+                    break
+                t -= duration
+            if frame != self.frames[gid]:
+                self._show(gid, frame)
+                changed[gid] = frame
+        return changed
+
+
+class TilesetImage(object):
+    '''The texture of a tileset image cut into tiles, shared by the
+    Tilesets of all the maps using the image (see TilesetCache.)
+
+        columns, tile_count - the number of columns of tiles, and of tiles
+        uvs - the (u1, v1, u2, v2) texture coordinates of each tile in turn
+    '''
+
+    def __init__(self, file, tile_width, tile_height, spacing=0, margin=0):
         texture = Image(source=file).texture
-        texture.mag_filter = 'nearest'
         if texture is None:
-            sys.exit('failed to locate image file %r' % file)
+            raise IOError('failed to locate image file %r' % file)
+        texture.mag_filter = 'nearest'
+        self.file = file
+        self.texture = texture
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.spacing = spacing
+        self.margin = margin
+        self.columns = texture.width // (tile_width + spacing)
+        rows = texture.height // (tile_height + spacing)
+        self.tile_count = self.columns * rows
+        self._regions = {}
+
+        w, h = float(texture.width), float(texture.height)
+        uvs = []
+        for index in xrange(self.tile_count):
+            x, y = self.region(index)
+            uvs.extend((x / w, y / h, (x + tile_width) / w,
+                        (y + tile_height) / h))
+        self.uvs = array.array('f', uvs)
 
-        id = self.firstgid
+    def __repr__(self):
+        return '<TilesetImage %s>' % self.file
+
+    def region(self, index):
+        '''Return the pixel position in the texture of the bottom-left
+        corner of the tile with the given index.
+        '''
         th = self.tile_height + self.spacing
         tw = self.tile_width + self.spacing
-        for j in xrange(texture.height / th):
-            for i in xrange(texture.width / tw):
-                x = (i * tw) + self.margin
-                # convert the y coordinate to OpenGL (0 at bottom of texture)
-                y = texture.height - ((j + 1) * th)
-                tile = texture.get_region(x, y, self.tile_width, self.tile_height)
-                self.tiles.append(Tile(id, tile, self))
-                id += 1
+        i, j = index % self.columns, index // self.columns
+        x = (i * tw) + self.margin
+        # convert the y coordinate to OpenGL (0 at bottom of texture)
+        y = self.texture.height - ((j + 1) * th)
+        return x, y
+
+    def get_region(self, index):
+        '''Return the texture of the tile with the given index.
+        '''
+        texture = self._regions.get(index)
+        if texture is None:
+            x, y = self.region(index)
+            texture = self._regions[index] = self.texture.get_region(
+                x, y, self.tile_width, self.tile_height)
+        return texture
+
+
+class TilesetCache(object):
+    '''A process-wide registry of the tileset images loaded for TileMaps, so
+    maps (or reloads of a map) using the same tileset image share its
+    texture, tile regions and uvs, whatever the tileset's firstgid in each
+    map and the map's scale.
+
+    TilesetImages are keyed off the absolute path of the image and how it's
+    cut into tiles. Each Tileset acquires its image here and releases it
+    in TileMap.release(); images no longer used by any map stay cached
+    until evict() is called.
+    '''
 
-    def get_tile(self, gid):
-        return self.tiles[gid - self.firstgid]
+    def __init__(self):
+        self._images = {}
+        self._refs = {}
 
+    def __len__(self):
+        return len(self._images)
+
+    def acquire(self, file, tile_width, tile_height, spacing=0, margin=0):
+        '''Return the TilesetImage for the image file cut into tiles,
+        loading it if necessary.
+        '''
+        key = (os.path.abspath(file), tile_width, tile_height, spacing,
+               margin)
+        image = self._images.get(key)
+        if image is None:
+            image = self._images[key] = TilesetImage(file, tile_width,
+                                                     tile_height, spacing,
+                                                     margin)
+            image._cache_key = key
+            self._refs[key] = 0
+        self._refs[key] += 1
+        return image
+
+    def release(self, image):
+        '''Note that a Tileset is no longer using the TilesetImage.
+        '''
+        key = getattr(image, '_cache_key', None)
+        if self._refs.get(key):
+            self._refs[key] -= 1
+
+    def evict(self):
+        '''Drop all the TilesetImages no longer used by any TileMap.
+        '''
+        for key, refs in list(self._refs.items()):
+            if not refs:
+                del self._images[key]
+                del self._refs[key]
 
-class Tilesets(dict):
-    def add(self, tileset):
-        for i, tile in enumerate(tileset.tiles):
-            i += tileset.firstgid
-            self[i] = tile
+
+tileset_cache = TilesetCache()
+
+
+class PropertyIndex(object):
+    '''An index from property name, and (name, value), to the items (Cell
+    positions or Objects) with that property, for Layer and ObjectLayer
+    find() and match().
+
+    Values which can't be hashed (eg. a list set on a Cell) can't be keys
+    of by_value; the items with them are kept per name in unhashable, with
+    their values, and compared by valued() instead.
+    '''
+
+    def __init__(self):
+        self.by_name = {}
+        self.by_value = {}
+        self.unhashable = {}
+
+    def add(self, item, name, value):
+        self.by_name.setdefault(name, set()).add(item)
+        try:
+            self.by_value.setdefault((name, value), set()).add(item)
+        except TypeError:
+            self.unhashable.setdefault(name, {})[item] = value
+
+    def remove(self, item, name, value):
+        self.by_name.get(name, set()).discard(item)
+        try:
+            self.by_value.get((name, value), set()).discard(item)
+        except TypeError:
+            self.unhashable.get(name, {}).pop(item, None)
+
+    def named(self, name):
+        return self.by_name.get(name, ())
+
+    def valued(self, name, value):
+        try:
+            items = self.by_value.get((name, value), ())
+        except TypeError:
+            items = ()
+        others = self.unhashable.get(name)
+        if not others:
+            return items
+        return set(items).union(item for item, other in others.items()
+                                if other == value)
+
+
+def _row_major(pos):
+    return pos[1], pos[0]
+
+
+def _flags(item, flag_bits):
+    # the flags of a Cell or Object with its own properties
+    flags = 0
+    for name, bit in flag_bits.items():
+        if name in item:
+            flags |= bit
+    return flags
+
+
+def time_of_impact(box, dx, dy, other):
+    '''Sweep the box (left, bottom, right, top) along (dx, dy) against the
+    other box.
+
+    Return (t, (nx, ny)) giving the fraction of the motion made before the
+    boxes touch and the normal of the side of the other box that was hit,
+    or None if they don't meet (or already overlap, or only graze.)
+    '''
+    ax1, ay1, ax2, ay2 = box
+    bx1, by1, bx2, by2 = other
+    if dx > 0:
+        tx1, tx2 = (bx1 - ax2) / float(dx), (bx2 - ax1) / float(dx)
+    elif dx < 0:
+        tx1, tx2 = (bx2 - ax1) / float(dx), (bx1 - ax2) / float(dx)
+    elif ax2 <= bx1 or ax1 >= bx2:
+        return None
+    else:
+        tx1, tx2 = float('-inf'), float('inf')
+    if dy > 0:
+        ty1, ty2 = (by1 - ay2) / float(dy), (by2 - ay1) / float(dy)
+    elif dy < 0:
+        ty1, ty2 = (by2 - ay1) / float(dy), (by1 - ay2) / float(dy)
+    elif ay2 <= by1 or ay1 >= by2:
+        return None
+    else:
+        ty1, ty2 = float('-inf'), float('inf')
+    t = max(tx1, ty1)
+    if t < 0 or t > 1 or t >= min(tx2, ty2):
+        return None
+    if tx1 > ty1:
+        return t, (-1 if dx > 0 else 1, 0)
+    return t, (0, -1 if dy > 0 else 1)
+
+
+# the side of a box hit, by contact normal
+_sides = {(-1, 0): 'l', (1, 0): 'r', (0, 1): 't', (0, -1): 'b'}
+
+
+def _blocks(value, normal):
+    # a property value made of the letters l, r, t and b only blocks on
+    # those sides; anything else blocks on all sides
+    if isinstance(value, basestring) and value and not value.strip('lrtb'):
+        return _sides[normal] in value
+    return True
+
+
+def _slide(layer, rect, dx, dy, propname, steps):
+    # see Layer.slide()
+    contacts = []
+    for n in xrange(steps):
+        if not (dx or dy):
+            break
+        hit = layer.sweep(rect, dx, dy, propname)
+        if hit is None:
+            rect.x += dx
+            rect.y += dy
+            return contacts, (0, 0)
+        t, normal, item, (rx, ry) = hit
+        rect.x += dx - rx
+        rect.y += dy - ry
+        # put the rect exactly against the side hit and carry on along it
+        nx, ny = normal
+        if nx < 0:
+            rect.right = item.left
+        elif nx > 0:
+            rect.left = item.right
+        elif ny > 0:
+            rect.bottom = item.top
+        else:
+            rect.top = item.bottom
+        contacts.append((normal, item))
+        if nx:
+            dx, dy = 0, ry
+        else:
+            dx, dy = rx, 0
+    return contacts, (dx, dy)
+
+
+def mesh_grid(values, width, height):
+    '''Greedily merge the cells of the width by height grid holding the
+    same value into maximal rectangles. The values are in row order, with
+    None for the cells to leave out.
+
+    Return a list of (i, j, w, h, value) in cells.
+    '''
+    used = bytearray(width * height)
+    rects = []
+    for j in xrange(height):
+        i = 0
+        while i < width:
+            k = j * width + i
+            value = values[k]
+            if value is None or used[k]:
+                i += 1
+                continue
+            # as wide as possible, then as tall as that width allows
+            w = 1
+            while (i + w < width and not used[k + w]
+                   and values[k + w] == value):
+                w += 1
+            h = 1
+            while j + h < height:
+                row = k + h * width
+                if any(used[row + n] or values[row + n] != value
+                       for n in xrange(w)):
+                    break
+                h += 1
+            for n in xrange(h):
+                used[k + n * width:k + n * width + w] = b'\x01' * w
+            rects.append((i, j, w, h, value))
+            i += w
+    return rects
+
+
+def merge_boxes(boxes):
+    '''Merge the boxes (x, y, width, height, value) which exactly share a
+    side and have the same value, until no more can be merged.
+
+    Return a list of the merged boxes.
+    '''
+    boxes = [list(box) for box in boxes]
+    while True:
+        count = len(boxes)
+        for axis in (0, 1):
+            # boxes which may join along this axis line up on the other
+            rows = collections.defaultdict(list)
+            for box in boxes:
+                rows[box[1 - axis], box[3 - axis], box[4]].append(box)
+            boxes = []
+            for row in rows.values():
+                row.sort(key=lambda box: box[axis])
+                box = row[0]
+                for other in row[1:]:
+                    if other[axis] == box[axis] + box[axis + 2]:
+                        box[axis + 2] += other[axis + 2]
+                    else:
+                        boxes.append(box)
+                        box = other
+                boxes.append(box)
+        if len(boxes) == count:
+            boxes.sort(key=lambda box: (box[1], box[0]))
+            return boxes
 
 
 class Cell(object):
@@ -155,6 +922,9 @@ class Cell(object):
     using the Cell's Tile.
     '''
 
+    # the Layer holding this Cell, which indexes its properties
+    _layer = None
+
     def __init__(self, x, y, px, py, tile):
         self.map_px = px
         self.map_py = py
@@ -189,10 +959,23 @@ class Cell(object):
         raise KeyError(key)
 
     def __setitem__(self, key, value):
+        if self._layer is not None:
+            self._layer._unindex(self, key)
         self._added_properties[key] = value
+        self._deleted_properties.discard(key)
+        if self._layer is not None:
+            self._layer._reindex(self, key)
 
     def __delitem__(self, key):
+        if self._layer is not None:
+            self._layer._unindex(self, key)
         self._deleted_properties.add(key)
+        if self._layer is not None:
+            self._layer._reindex(self, key)
+
+    def keys(self):
+        return [key for key in set(self.tile.properties) | set(self._added_properties)
+                if key in self]
 
     def intersects(self, other):
         '''Determine whether this Cell intersects with the other rect (which has
@@ -209,6 +992,420 @@ class Cell(object):
         return True
 
 
+class CellGrid(object):
+    '''A compact replacement for the Layer.cells dict which only stores the
+    Layer's gid array.
+
+    Cell instances are created as views on the grid when they are looked up
+    and are only held on to while in use elsewhere, unless they have had
+    their properties modified (in which case they are kept so the change
+    sticks.)
+
+    Supports the same lookups as the dict:
+
+        grid.get((x, y)), grid[x, y], (x, y) in grid, len(grid),
+        grid.keys(), grid.values(), grid.items()
+    '''
+
+    def __init__(self, layer, gids):
+        self.layer = layer
+        self.gids = gids
+        self._views = weakref.WeakValueDictionary()
+        self._pinned = {}
+
+    def __repr__(self):
+        return '<CellGrid for %r>' % self.layer
+
+    def _gid(self, pos):
+        x, y = pos
+        if not (0 <= x < self.layer.width and 0 <= y < self.layer.height):
+            return 0
+        return self.gids[x + y * self.layer.width]
+
+    def get(self, pos, default=None):
+        cell = self._views.get(pos)
+        if cell is not None:
+            return cell
+        gid = self._gid(pos)
+        if gid < 1:
+            return default
+        x, y = pos
+        cell = Cell(x, y, x * self.layer.tile_width, y * self.layer.tile_height,
+                    self.layer.tilesets[gid])
+        cell._layer = self.layer
+        self._views[pos] = cell
+        return cell
+
+    def __getitem__(self, pos):
+        cell = self.get(pos)
+        if cell is None:
+            raise KeyError(pos)
+        return cell
+
+    def __contains__(self, pos):
+        return self._gid(pos) > 0
+
+    def __setitem__(self, pos, cell):
+        x, y = pos
+        self.gids[x + y * self.layer.width] = cell.tile.gid
+        cell._layer = self.layer
+        self._views[pos] = cell
+        self._pinned[pos] = cell
+
+    def __delitem__(self, pos):
+        self.layer._remove(self[pos])
+        x, y = pos
+        self.gids[x + y * self.layer.width] = 0
+        self._views.pop(pos, None)
+        self._pinned.pop(pos, None)
+
+    def __len__(self):
+        return len(self.gids) - self.gids.count(0)
+
+    def __iter__(self):
+        w = self.layer.width
+        for i, gid in enumerate(self.gids):
+            if gid > 0:
+                yield i % w, i // w
+
+    def pin(self, cell):
+        '''Hold on to the Cell view (it has been modified.)
+        '''
+        self._pinned[cell.x, cell.y] = cell
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self.get(pos) for pos in self]
+
+    def items(self):
+        return [(pos, self.get(pos)) for pos in self]
+
+
+class PagedGids(object):
+    '''A stand-in for the Layer.gids array of a paged Layer which only
+    holds some square pages of the grid in memory, reading the others in
+    from the compiled map (see tmxcache) when they are accessed.
+
+    Supports indexing, assignment, iteration and len() like the array.
+
+    At most "limit" pages are kept; the least recently used pages are
+    dropped to make room, except for those covering the current view
+    (plus a margin of tiles) and those which have been assigned to.
+    '''
+
+    def __init__(self, source, width, height, size=32, margin=8, limit=64):
+        self.source = source
+        self.width = width
+        self.height = height
+        self.size = size
+        self.margin = margin
+        self.limit = limit
+        self._pages = collections.OrderedDict()
+        self._wanted = set()
+        self._dirty = set()
+
+    def __repr__(self):
+        return '<PagedGids %d/%d pages>' % (len(self._pages), self.limit)
+
+    def __len__(self):
+        return self.width * self.height
+
+    def page(self, pi, pj):
+        '''Return the array holding the gids of page (pi, pj), reading it
+        in if necessary.
+        '''
+        key = (pi, pj)
+        page = self._pages.pop(key, None)
+        if page is None:
+            size = self.size
+            page = self.source.read(pi * size, pj * size, size, size)
+        self._pages[key] = page
+        if len(self._pages) > self.limit:
+            self._evict()
+        return page
+
+    def _evict(self):
+        for key in list(self._pages):
+            if len(self._pages) <= self.limit:
+                break
+            if key not in self._wanted and key not in self._dirty:
+                del self._pages[key]
+
+    def _locate(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        x, y = i % self.width, i // self.width
+        return (x // self.size, y // self.size), (y % self.size) * self.size + x % self.size
+
+    def __getitem__(self, i):
+        key, offset = self._locate(i)
+        return self.page(*key)[offset]
+
+    def __setitem__(self, i, gid):
+        key, offset = self._locate(i)
+        self.page(*key)[offset] = gid
+        self._dirty.add(key)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def count(self, gid):
+        return sum(1 for g in self if g == gid)
+
+    def require(self, i1, j1, i2, j2):
+        '''Make sure the pages covering the cells (i1, j1) to (i2, j2)
+        inclusive, plus the margin, are in memory and keep them there until
+        the next require().
+        '''
+        size, margin = self.size, self.margin
+        pi1 = max(0, i1 - margin) // size
+        pj1 = max(0, j1 - margin) // size
+        pi2 = min(self.width - 1, i2 + margin) // size
+        pj2 = min(self.height - 1, j2 + margin) // size
+        self._wanted = set((pi, pj) for pi in xrange(pi1, pi2 + 1)
+                           for pj in xrange(pj1, pj2 + 1))
+        for key in sorted(self._wanted):
+            self.page(*key)
+
+
+class Field(object):
+    '''The distance of each cell of a Layer from the nearest cell with a
+    property (by default "blocker") set, and the connected regions of the
+    cells without it. See Layer.field().
+
+        distances - an array in row order of the distance of each cell, in
+                    steps to the cell's four neighbours, to the nearest
+                    cell with the property (0 for those cells, or far if
+                    there are none)
+        labels - an array in row order of the region each cell without the
+                 property is in (0 for the cells with it); cells in the
+                 same region are connected by their four neighbours
+
+    These are worked out in full when first asked for and then kept up to
+    date with just the cells which have changed since (found through
+    Layer.version and Layer.property_mask()).
+    '''
+
+    far = 0x7fffffff
+
+    def __init__(self, layer, propname='blocker'):
+        self.layer = layer
+        self.propname = propname
+        self.width = layer.width
+        self.height = layer.height
+        self._version = layer.version
+        self._blocked = bytearray(layer.property_mask(propname))
+        self._build()
+
+    def __repr__(self):
+        return '<Field "%s" for %r>' % (self.propname, self.layer)
+
+    def distance(self, x, y):
+        '''Return the distance of the cell (x, y) from the nearest cell with
+        the property.
+        '''
+        self.refresh()
+        return self.distances[x + y * self.width]
+
+    def region(self, x, y):
+        '''Return the label of the region the cell (x, y) is in, or 0 if
+        the cell has the property.
+        '''
+        self.refresh()
+        return self.labels[x + y * self.width]
+
+    def connected(self, a, b):
+        '''Return whether there is a way between the cells a and b (both
+        (x, y)) through the cells without the property.
+        '''
+        region = self.region(*a)
+        return region != 0 and region == self.region(*b)
+
+    def refresh(self):
+        '''Bring the field up to date with any changes to the Layer's cells.
+        '''
+        if self._version == self.layer.version:
+            return
+        self._version = self.layer.version
+        mask = self.layer.property_mask(self.propname)
+        old, w = self._blocked, self.width
+        for j in xrange(self.height):
+            start = j * w
+            if mask[start:start + w] == old[start:start + w]:
+                continue
+            for k in xrange(start, start + w):
+                if mask[k] != old[k]:
+                    old[k] = mask[k]
+                    if mask[k]:
+                        self._blocked_at(k)
+                    else:
+                        self._opened_at(k)
+
+    def _around(self, k):
+        w = self.width
+        x = k % w
+        if x:
+            yield k - 1
+        if x < w - 1:
+            yield k + 1
+        if k >= w:
+            yield k - w
+        if k + w < w * self.height:
+            yield k + w
+
+    def _build(self):
+        blocked, n = self._blocked, self.width * self.height
+        self.distances = array.array('i', [self.far]) * n
+        queue = collections.deque()
+        k = blocked.find(b'\x01')
+        while k != -1:
+            self.distances[k] = 0
+            queue.append(k)
+            k = blocked.find(b'\x01', k + 1)
+        self._lower(queue)
+
+        self.labels = array.array('i', [0]) * n
+        self._sizes = {}
+        self._next_label = 1
+        for k in xrange(n):
+            if not blocked[k] and not self.labels[k]:
+                self._flood(k, 0)
+
+    def _lower(self, queue):
+        # spread shorter distances out from the queued cells
+        distances, around = self.distances, self._around
+        while queue:
+            k = queue.popleft()
+            d = distances[k] + 1
+            for n in around(k):
+                if distances[n] > d:
+                    distances[n] = d
+                    queue.append(n)
+
+    def _flood(self, k, old):
+        # give the region of cells labelled old around k a new label
+        label = self._next_label
+        self._next_label += 1
+        labels, around = self.labels, self._around
+        blocked = self._blocked
+        labels[k] = label
+        stack, count = [k], 1
+        while stack:
+            for n in around(stack.pop()):
+                if labels[n] == old and not blocked[n]:
+                    labels[n] = label
+                    stack.append(n)
+                    count += 1
+        self._sizes[label] = count
+        if old:
+            self._sizes[old] -= count
+            if not self._sizes[old]:
+                del self._sizes[old]
+        return label
+
+    def _blocked_at(self, k):
+        distances = self.distances
+        distances[k] = 0
+        self._lower(collections.deque([k]))
+
+        label = self.labels[k]
+        self.labels[k] = 0
+        self._sizes[label] -= 1
+        if not self._sizes[label]:
+            del self._sizes[label]
+            return
+        if self._ring_connected(k):
+            return
+        # the region may have been split; label each part afresh
+        for n in self._around(k):
+            if self.labels[n] == label:
+                self._flood(n, label)
+
+    def _ring_connected(self, k):
+        # whether the open neighbours of k are still joined through the
+        # eight cells around it, in which case k can't split its region
+        w, h = self.width, self.height
+        x, y = k % w, k // w
+        ring = []
+        for dx, dy in ((0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1),
+                       (-1, 0), (-1, -1)):
+            i, j = x + dx, y + dy
+            ring.append(0 <= i < w and 0 <= j < h and
+                        not self._blocked[i + j * w])
+        # the runs of open cells around the ring holding a neighbour
+        runs = 0
+        for n in (0, 2, 4, 6):
+            if ring[n] and not (ring[n - 1] and ring[n - 2]):
+                runs += 1
+        return runs <= 1
+
+    def _opened_at(self, k):
+        labels = [self.labels[n] for n in self._around(k)
+                  if not self._blocked[n]]
+        if not labels:
+            label = self._next_label
+            self._next_label += 1
+            self._sizes[label] = 0
+        else:
+            # join the neighbouring regions into the largest
+            label = max(labels, key=self._sizes.get)
+            for other in set(labels) - set([label]):
+                for n in self._around(k):
+                    if self.labels[n] == other:
+                        size = self._sizes.pop(other)
+                        self._relabel(n, other, label)
+                        self._sizes[label] += size
+                        break
+        self.labels[k] = label
+        self._sizes[label] += 1
+
+        # distances can only grow; clear those which may have come from k
+        # and work them out again from the cells around them
+        distances, around = self.distances, self._around
+        cleared = set([k])
+        stack = [k]
+        while stack:
+            c = stack.pop()
+            d = distances[c] + 1
+            for n in around(c):
+                if n not in cleared and distances[n] == d:
+                    cleared.add(n)
+                    stack.append(n)
+        for c in cleared:
+            distances[c] = self.far
+        queue = []
+        for c in cleared:
+            for n in around(c):
+                if n not in cleared and distances[n] + 1 < distances[c]:
+                    distances[c] = distances[n] + 1
+            if distances[c] < self.far:
+                queue.append((distances[c], c))
+        heapq.heapify(queue)
+        while queue:
+            d, c = heapq.heappop(queue)
+            if d > distances[c]:
+                continue
+            for n in around(c):
+                if distances[n] > d + 1:
+                    distances[n] = d + 1
+                    heapq.heappush(queue, (d + 1, n))
+
+    def _relabel(self, k, old, new):
+        labels, around = self.labels, self._around
+        labels[k] = new
+        stack = [k]
+        while stack:
+            for n in around(stack.pop()):
+                if labels[n] == old:
+                    labels[n] = new
+                    stack.append(n)
+
+
 class LayerIterator(object):
     '''Iterates over all the cells in a layer in column,row order.
     '''
@@ -240,17 +1437,43 @@ class Layer(object):
         px_width, px_height - the dimensions of the Layer in pixels
         tilesets - the tilesets used in this Layer (a Tilesets instance)
         properties - any properties set for this Layer
+        gids - an array of the tile gid of every cell in row order (0 for
+               empty cells)
         cells - a dict of all the Cell instances for this Layer, keyed off
-                (x, y) index.
+                (x, y) index. For maps loaded with compact=True this is a
+                CellGrid which creates the Cells on demand from the gids.
+        version - a count of the changes made to the cells, for those
+                  caching things worked out from them (eg. pathfind.NavGrid)
+
+    Layers of maps loaded with paged=True have PagedGids for their gids and
+    only keep the parts of the map around the view in memory.
 
     Additionally you may look up a cell using direct item access:
 
        layer[x, y] is layer.cells[x, y]
 
     Note that empty cells will be set to None instead of a Cell instance.
+
+    The cells' properties are indexed (see build_index()) for find() and
+    match(); the index is kept up to date as cells are set and their
+    properties changed.
+
+    Many boxes may be tested against the Layer at once with collide_many().
+
+    Moving rects may be stopped against the cells with sweep() and slide(),
+    and rays cast through the cells with raycast() and raycast_many().
+
+    How far cells are from those with a property, and which cells without
+    it are connected, are given by the Field returned by field().
+
+    The map's flag_properties are compiled into a bit per property in the
+    flags of each cell: flags is a bytearray in row order like the gids
+    (or None for paged Layers), kept up to date as cells and their
+    properties change, and used by collide() to skip the cells without the
+    property.
     '''
 
-    def __init__(self, name, visible, map):
+    def __init__(self, name, visible, map, gids=None):
         self.name = name
         self.visible = visible
         self.position = (0, 0)
@@ -262,7 +1485,17 @@ class Layer(object):
         self.height = map.height
         self.tilesets = map.tilesets
         self.properties = {}
+        if gids is None:
+            gids = array.array('I', [0]) * (self.width * self.height)
+        self.gids = gids
         self.cells = {}
+        self.flag_bits = map.flag_bits
+        self.flags = None
+        self.version = 0
+        self._index = None
+        self._tiles = None
+        self._masks = {}
+        self._fields = {}
 
     def __repr__(self):
         return '<Layer "%s" at 0x%x>' % (self.name, id(self))
@@ -272,71 +1505,335 @@ class Layer(object):
 
     def __setitem__(self, pos, tile):
         x, y = pos
+        old = self.cells.get(pos)
+        if old is not None:
+            for key in old.keys():
+                self._unindex(old, key)
         px = x * self.tile_width
         py = y * self.tile_width
-        self.cells[pos] = Cell(x, y, px, py, tile)
+        cell = Cell(x, y, px, py, tile)
+        cell._layer = self
+        self.cells[pos] = cell
+        self.gids[x + y * self.width] = tile.gid
+        for key in cell.keys():
+            self._reindex(cell, key)
+        for key, mask in self._masks.items():
+            mask[x + y * self.width] = key in cell
+        if self.flags is not None:
+            self.flags[x + y * self.width] = _flags(cell, self.flag_bits)
+        self.version += 1
 
     def __iter__(self):
         return LayerIterator(self)
 
     @classmethod
-    def fromxml(cls, tag, map):
-        layer = cls(tag.attrib['name'], int(tag.attrib.get('visible', 1)), map)
+    def parsexml(cls, tag, pool=None):
+        '''Parse a <layer> tag into a plain dict describing the layer (see
+        fromdata()). The gids are decoded into an array in row order.
 
+        If a thread pool is given the gids are decoded on it, and the
+        description holds functions returning the gids in their place (see
+        decode_gids_async()) which TileMap.parsexml() resolves.
+        '''
+        name = tag.attrib['name']
         data = tag.find('data')
         if data is None:
-            raise ValueError('layer %s does not contain <data>' % layer.name)
-
-        data = data.text.strip()
-        data = data.decode('base64').decode('zlib')
-        data = struct.unpack('<%di' % (len(data) / 4,), data)
-        assert len(data) == layer.width * layer.height, "data len (%d) != width (%d) x height (%d)" % (
-        len(data), layer.width, layer.height)
-        for i, gid in enumerate(data):
-            if gid < 1: continue  # not set
-            tile = map.tilesets[gid]
-            x = i % layer.width
-            y = i // layer.width
-            layer.cells[x, y] = Cell(x, y, x * layer.tile_width, y * layer.tile_height, tile)
+            raise ValueError('layer %s does not contain <data>' % name)
 
+        if pool is None:
+            decode = decode_gids
+        else:
+            decode = lambda data, tag=None: decode_gids_async(pool, data, tag)
+
+        layer = dict(name=name, visible=int(tag.attrib.get('visible', 1)))
+        chunks = data.findall('chunk')
+        if chunks:
+            # infinite map; see TileMap.parsexml()
+            layer['chunks'] = [[int(c.attrib['x']), int(c.attrib['y']),
+                                int(c.attrib['width']),
+                                int(c.attrib['height']), decode(data, c)]
+                               for c in chunks]
+        else:
+            layer['gids'] = decode(data)
+        return layer
+
+    @classmethod
+    def fromdata(cls, data, map):
+        '''Create a Layer from the dict produced by parsexml().
+        '''
+        gids = data['gids']
+        if isinstance(gids, tmxcache.GidFile):
+            gids = PagedGids(gids, map.width, map.height, map.page_size,
+                             map.page_margin, map.page_limit)
+        layer = cls(data['name'], data['visible'], map, gids)
+        assert len(gids) == layer.width * layer.height, "data len (%d) != width (%d) x height (%d)" % (
+        len(gids), layer.width, layer.height)
+        if isinstance(gids, PagedGids):
+            # indexed on first use, rather than paging the whole map in now
+            layer.cells = CellGrid(layer, gids)
+            return layer
+        if map.compact:
+            layer.cells = CellGrid(layer, gids)
+        else:
+            for i, gid in enumerate(gids):
+                if gid < 1: continue  # not set
+                tile = map.tilesets[gid]
+                x = i % layer.width
+                y = i // layer.width
+                cell = Cell(x, y, x * layer.tile_width, y * layer.tile_height, tile)
+                cell._layer = layer
+                layer.cells[x, y] = cell
+
+        layer.build_index()
+        layer.build_flags()
         return layer
 
+    @classmethod
+    def fromxml(cls, tag, map):
+        return cls.fromdata(cls.parsexml(tag), map)
+
     def update(self, dt, *args):
         pass
 
     def set_view(self, x, y, w, h, viewport_ox=0, viewport_oy=0):
         self.view_x, self.view_y = x, y
         self.view_w, self.view_h = w, h
+        if isinstance(self.gids, PagedGids):
+            # the view is in OpenGL space, y up from the bottom of the map
+            y1 = self.px_height - (y + h)
+            self.gids.require(int(x // self.tile_width),
+                              int(y1 // self.tile_height),
+                              int((x + w) // self.tile_width),
+                              int((y1 + h) // self.tile_height))
         x -= viewport_ox
         y -= viewport_oy
         self.position = (x, y)
 
+    def build_index(self):
+        '''Build the index of cell properties used by find() and match().
+
+        This is done when the Layer is loaded (or for paged Layers the first
+        time it's needed) and need only be called again if the gids or cells
+        are changed directly rather than through the Layer and Cells.
+
+        Layers whose cells are a CellGrid don't hold an entry for every
+        cell: only which tiles (by gid) have each property is indexed, and
+        the cells are found by looking through the gids for those tiles
+        (see property_mask()) and at the cells with their own properties.
+        '''
+        index = PropertyIndex()
+
+        # find the cells through their tiles' properties
+        properties = {}
+        for tileset in self.tilesets.sets:
+            for gid, props in tileset.tile_properties.items():
+                if props:
+                    properties[gid] = props
+        self._masks = {}
+        if isinstance(self.cells, CellGrid):
+            for gid, props in properties.items():
+                for name, value in props.items():
+                    index.add(gid, name, value)
+            self._tiles = index
+            return
+        if properties:
+            w = self.width
+            for i, gid in enumerate(self.gids):
+                if gid in properties:
+                    for name, value in properties[gid].items():
+                        index.add((i % w, i // w), name, value)
+
+        # and then take into account those cells with their own properties
+        if isinstance(self.cells, CellGrid):
+            cells = self.cells._pinned.values()
+        else:
+            cells = self.cells.values()
+        for cell in cells:
+            if cell._added_properties or cell._deleted_properties:
+                pos = cell.x, cell.y
+                for name, value in cell.tile.properties.items():
+                    index.remove(pos, name, value)
+                for name in cell.keys():
+                    index.add(pos, name, cell[name])
+        self._index = index
+
+    def build_flags(self):
+        '''Compile the flags of every cell from the tile properties (see
+        Tilesets.flags()) and the cells' own properties.
+
+        This is done when the Layer is loaded and need only be called again
+        if the gids or cells are changed directly.
+        '''
+        if any(bit > 0x80 for bit in self.flag_bits.values()):
+            raise ValueError('the flag_bits of a Layer must fit in a byte: %r'
+                             % self.flag_bits)
+        table = self.tilesets.flags(self.flag_bits)
+        flags = bytearray(len(self.gids))
+        if table:
+            get = table.get
+            for k, gid in enumerate(self.gids):
+                if gid in table:
+                    flags[k] = get(gid)
+        if isinstance(self.cells, CellGrid):
+            cells = self.cells._pinned.values()
+        else:
+            cells = self.cells.values()
+        for cell in cells:
+            if cell._added_properties or cell._deleted_properties:
+                flags[cell.x + cell.y * self.width] = _flags(cell,
+                                                             self.flag_bits)
+        self.flags = flags
+        self.version += 1
+
+    def _unindex(self, cell, key):
+        # cell property key is about to change
+        if self._index is not None and key in cell:
+            self._index.remove((cell.x, cell.y), key, cell[key])
+
+    def _reindex(self, cell, key):
+        # cell property key has changed
+        if isinstance(self.cells, CellGrid):
+            self.cells.pin(cell)
+        if self._index is not None and key in cell:
+            self._index.add((cell.x, cell.y), key, cell[key])
+        if key in self._masks:
+            self._masks[key][cell.x + cell.y * self.width] = key in cell
+        bit = self.flag_bits.get(key)
+        if bit and self.flags is not None:
+            k = cell.x + cell.y * self.width
+            if key in cell:
+                self.flags[k] |= bit
+            else:
+                self.flags[k] &= ~bit
+        self.version += 1
+
+    def _remove(self, cell):
+        # cell is about to be emptied
+        for key in cell.keys():
+            self._unindex(cell, key)
+        k = cell.x + cell.y * self.width
+        for mask in self._masks.values():
+            mask[k] = 0
+        if self.flags is not None:
+            self.flags[k] = 0
+        cell._layer = None
+        self.version += 1
+
+    def field(self, propname='blocker'):
+        '''Return the Field of the distances from, and regions around, the
+        cells with the indicated property name set.
+
+        The Field is kept and brought up to date as the cells change.
+        '''
+        field = self._fields.get(propname)
+        if field is None:
+            field = self._fields[propname] = Field(self, propname)
+        field.refresh()
+        return field
+
+    def property_mask(self, propname):
+        '''Return a bytearray holding 1 for each cell (in row order, like
+        the gids) with the property set and 0 for the others.
+
+        The mask is kept up to date as cells and their properties change.
+        '''
+        mask = self._masks.get(propname)
+        if mask is None:
+            if isinstance(self.cells, CellGrid):
+                if self._tiles is None:
+                    self.build_index()
+                mask = self._grid_mask(self._tiles.named(propname),
+                                       lambda cell: propname in cell)
+            else:
+                if self._index is None:
+                    self.build_index()
+                mask = bytearray(self.width * self.height)
+                w = self.width
+                for x, y in self._index.named(propname):
+                    mask[x + y * w] = 1
+            self._masks[propname] = mask
+        return mask
+
+    def _grid_mask(self, gids, test):
+        # the mask of the cells of a CellGrid with a tile in gids, or for
+        # those with their own properties the cells passing test
+        if gids:
+            mask = bytearray(gid in gids for gid in self.gids)
+        else:
+            mask = bytearray(len(self.gids))
+        w = self.width
+        for (x, y), cell in self.cells._pinned.items():
+            mask[x + y * w] = test(cell)
+        return mask
+
+    def _masked(self, mask):
+        # the cells set in the mask, in row order
+        w = self.width
+        r = []
+        k = mask.find(b'\x01')
+        while k != -1:
+            r.append(self.cells[k % w, k // w])
+            k = mask.find(b'\x01', k + 1)
+        return r
+
     def find(self, *properties):
         '''Find all cells with the given properties set.
         '''
+        if isinstance(self.cells, CellGrid):
+            r = []
+            for propname in properties:
+                r.extend(self._masked(self.property_mask(propname)))
+            return r
+        if self._index is None:
+            self.build_index()
         r = []
         for propname in properties:
-            for cell in self.cells.values():
-                if cell and propname in cell:
-                    r.append(cell)
+            r.extend(self.cells[pos] for pos in
+                     sorted(self._index.named(propname), key=_row_major))
         return r
 
     def match(self, **properties):
         '''Find all cells with the given properties set to the given values.
         '''
+        if isinstance(self.cells, CellGrid):
+            if self._tiles is None:
+                self.build_index()
+            r = []
+            for propname in properties:
+                value = properties[propname]
+                test = lambda cell: propname in cell and cell[propname] == value
+                r.extend(self._masked(self._grid_mask(
+                    self._tiles.valued(propname, value), test)))
+            return r
+        if self._index is None:
+            self.build_index()
         r = []
         for propname in properties:
-            for cell in self.cells.values():
-                if propname not in cell:
-                    continue
-                if properties[propname] == cell[propname]:
-                    r.append(cell)
+            r.extend(self.cells[pos] for pos in
+                     sorted(self._index.valued(propname, properties[propname]),
+                            key=_row_major))
         return r
 
     def collide(self, rect, propname):
         '''Find all cells the rect is touching that have the indicated property
         name set.
         '''
+        bit = self.flag_bits.get(propname)
+        if bit and self.flags is not None:
+            # only look up the cells flagged as having the property
+            i1 = max(0, int(rect.left // self.tile_width))
+            j1 = max(0, int(rect.bottom // self.tile_height))
+            i2 = min(self.width, int(rect.right // self.tile_width) + 1)
+            j2 = min(self.height, int(rect.top // self.tile_height) + 1)
+            flags, w = self.flags, self.width
+            r = []
+            for i in xrange(i1, i2):
+                for j in xrange(j1, j2):
+                    if flags[i + j * w] & bit:
+                        cell = self.cells[i, j]
+                        if cell.intersects(rect):
+                            r.append(cell)
+            return r
         r = []
         for cell in self.get_in_region(rect.left, rect.bottom, rect.right,
                                        rect.top):
@@ -346,6 +1843,190 @@ class Layer(object):
                 r.append(cell)
         return r
 
+    def collide_many(self, boxes, propname):
+        '''Find the cells touched by each of many boxes that have the
+        indicated property name set.
+
+        The boxes are a flat sequence (eg. an array('f')) of (left, bottom,
+        right, top) in the same space as collide(). Return two arrays of
+        equal length, each hit being the index of the box in the sequence
+        and the index of the cell in the gids (ie. x + y * width); the hits
+        for each box are in row order.
+        '''
+        mask = self.property_mask(propname)
+        tw, th, w, h = self.tile_width, self.tile_height, self.width, self.height
+        hit_boxes, hit_cells = array.array('i'), array.array('i')
+        find = mask.find
+        one = b'\x01'
+        for n in xrange(len(boxes) // 4):
+            x1, y1, x2, y2 = boxes[n * 4:n * 4 + 4]
+            i1 = max(0, int(x1 // tw))
+            i2 = min(w, int(x2 // tw) + 1)
+            if i1 >= i2:
+                continue
+            for j in xrange(max(0, int(y1 // th)), min(h, int(y2 // th) + 1)):
+                end = j * w + i2
+                k = find(one, j * w + i1, end)
+                while k != -1:
+                    hit_boxes.append(n)
+                    hit_cells.append(k)
+                    k = find(one, k + 1, end)
+        return hit_boxes, hit_cells
+
+    def sweep(self, rect, dx, dy, propname):
+        '''Find the first cell with the indicated property name set that the
+        rect hits when moved by (dx, dy), looking only at the cells along
+        the way.
+
+        If the property's value is made of the letters l, r, t and b (as
+        in the "blocker" property of the platformer) only those sides of
+        the cell are hit; other values make all sides hit. The sides are as
+        seen on screen: t is the side towards row 0, which in the Layer's
+        space (y down) has the smaller y.
+
+        Return (t, (nx, ny), cell, (rdx, rdy)) giving the fraction of the
+        motion made before the hit, the normal of the side of the cell hit,
+        the cell and the remaining motion, or None if nothing is hit.
+        '''
+        box = rect.left, rect.bottom, rect.right, rect.top
+        mask = self.property_mask(propname)
+        tw, th, w = self.tile_width, self.tile_height, self.width
+        i1 = max(0, int(min(box[0], box[0] + dx) // tw))
+        i2 = min(w, int(max(box[2], box[2] + dx) // tw) + 1)
+        j1 = max(0, int(min(box[1], box[1] + dy) // th))
+        j2 = min(self.height, int(max(box[3], box[3] + dy) // th) + 1)
+        best = None
+        one = b'\x01'
+        for j in xrange(j1, j2):
+            end = j * w + i2
+            k = mask.find(one, j * w + i1, end)
+            while k != -1:
+                i = k - j * w
+                hit = time_of_impact(box, dx, dy, (i * tw, j * th,
+                                                   (i + 1) * tw, (j + 1) * th))
+                if hit is not None and (best is None or hit[0] < best[0]):
+                    cell = self.cells[i, j]
+                    # OpenGL vs. TMX, y is reversed
+                    nx, ny = hit[1]
+                    if _blocks(cell[propname], (nx, -ny)):
+                        best = hit + (cell,)
+                k = mask.find(one, k + 1, end)
+        if best is None:
+            return None
+        t, normal, cell = best
+        return t, normal, cell, (dx * (1 - t), dy * (1 - t))
+
+    def raycast(self, x, y, dx, dy, propname='blocker'):
+        '''Cast a ray from (x, y) to (x + dx, y + dy), in the same space as
+        collide(), through the cells it crosses until one has the indicated
+        property name set.
+
+        Return (t, (nx, ny), cell, (hx, hy)) giving the fraction of the way
+        along the ray, the normal of the side of the cell hit (or (0, 0) if
+        the ray starts in the cell), the cell and the point hit, or None if
+        the ray doesn't hit such a cell.
+        '''
+        hit = self._cast(self.property_mask(propname), x, y, dx, dy)
+        if hit is None:
+            return None
+        t, normal, k = hit
+        cell = self.cells[k % self.width, k // self.width]
+        return t, normal, cell, (x + dx * t, y + dy * t)
+
+    def raycast_many(self, rays, propname='blocker'):
+        '''Cast many rays as raycast() does.
+
+        The rays are a flat sequence (eg. an array('f')) of (x, y, dx, dy).
+        Return three arrays: the index in the gids of the cell each ray hit
+        (or -1 if it hit nothing), the fraction of the way along each ray
+        of the hit and the normals of the hits as pairs of (nx, ny).
+        '''
+        mask = self.property_mask(propname)
+        cells, times, normals = (array.array('i'), array.array('d'),
+                                 array.array('b'))
+        for n in xrange(len(rays) // 4):
+            hit = self._cast(mask, *rays[n * 4:n * 4 + 4])
+            if hit is None:
+                cells.append(-1)
+                times.append(1)
+                normals.extend((0, 0))
+            else:
+                t, normal, k = hit
+                cells.append(k)
+                times.append(t)
+                normals.extend(normal)
+        return cells, times, normals
+
+    def _cast(self, mask, x, y, dx, dy):
+        # Amanatides & Woo: step from cell to cell along the ray, always
+        # across whichever of the next column or row boundary is nearer
+        tw, th, w, h = self.tile_width, self.tile_height, self.width, self.height
+        inf = float('inf')
+
+        # clip the ray to the grid, noting the side it enters by
+        t0, t1, normal = 0., 1., (0, 0)
+        for axis, p, d, size in ((0, x, dx, w * tw), (1, y, dy, h * th)):
+            if d:
+                a, b = -p / float(d), (size - p) / float(d)
+                if a > b:
+                    a, b = b, a
+                if a > t0:
+                    t0 = a
+                    side = -1 if d > 0 else 1
+                    normal = (side, 0) if axis == 0 else (0, side)
+                t1 = min(t1, b)
+            elif not 0 <= p < size:
+                return None
+        if t0 >= t1 and (dx or dy):
+            return None
+
+        px, py = x + dx * t0, y + dy * t0
+        i, j = int(px // tw), int(py // th)
+        # on a boundary, start in the cell the ray is heading into
+        if dx < 0 and px == i * tw:
+            i -= 1
+        if dy < 0 and py == j * th:
+            j -= 1
+        i, j = min(max(i, 0), w - 1), min(max(j, 0), h - 1)
+
+        if dx:
+            si = 1 if dx > 0 else -1
+            tx = ((i + (dx > 0)) * tw - x) / float(dx)
+            ddx = tw / float(abs(dx))
+        else:
+            si, tx, ddx = 0, inf, inf
+        if dy:
+            sj = 1 if dy > 0 else -1
+            ty = ((j + (dy > 0)) * th - y) / float(dy)
+            ddy = th / float(abs(dy))
+        else:
+            sj, ty, ddy = 0, inf, inf
+
+        t = t0
+        while True:
+            k = i + j * w
+            if mask[k]:
+                return t, normal, k
+            if tx < ty:
+                t, i, normal = tx, i + si, (-si, 0)
+                tx += ddx
+            else:
+                t, j, normal = ty, j + sj, (0, -sj)
+                ty += ddy
+            if t > t1 or not (0 <= i < w and 0 <= j < h):
+                return None
+
+    def slide(self, rect, dx, dy, propname, steps=3):
+        '''Move the rect (in place) by (dx, dy), stopping against the sides
+        of the cells with the indicated property name set (see sweep()) and
+        sliding along them with the rest of the motion, for up to "steps"
+        contacts.
+
+        Return a list of the contacts as ((nx, ny), cell) and the motion
+        left over if the steps ran out.
+        '''
+        return _slide(self, rect, dx, dy, propname, steps)
+
     def get_in_region(self, x1, y1, x2, y2):
         '''Return cells (in [column][row]) that are within the map-space
         pixel bounds specified by the bottom-left (x1, y1) and top-right
@@ -403,8 +2084,18 @@ class Object(object):
         height: The height of the object in pixels (defaults to 0).
         gid: An reference to a tile (optional).
         visible: Whether the object is shown (1) or hidden (0). Defaults to 1.
+
+    Objects may be repositioned with move() and move_to(), which keep the
+    ObjectLayer's collision grid up to date.
+
+    The flags of an Object hold a bit for each of its ObjectLayer's
+    flag_bits properties it has (see ObjectLayer.build_flags()).
     '''
 
+    # the ObjectLayer holding this Object, which indexes its properties
+    _layer = None
+    flags = 0
+
     def __init__(self, type, x, y, width=0, height=0, name=None,
                  gid=None, tile=None, visible=1):
         self.type = type
@@ -456,44 +2147,69 @@ class Object(object):
         raise KeyError(key)
 
     def __setitem__(self, key, value):
+        if self._layer is not None:
+            self._layer._unindex(self, key)
         self._added_properties[key] = value
+        self._deleted_properties.discard(key)
+        if self._layer is not None:
+            self._layer._reindex(self, key)
 
     def __delitem__(self, key):
+        if self._layer is not None:
+            self._layer._unindex(self, key)
         self._deleted_properties.add(key)
+        if self._layer is not None:
+            self._layer._reindex(self, key)
+
+    def keys(self):
+        keys = set(self.properties) | set(self._added_properties)
+        if self.tile:
+            keys |= set(self.tile.properties)
+        return [key for key in keys if key in self]
 
     @classmethod
-    def fromxml(cls, tag, map):
-        if 'gid' in tag.attrib:
-            gid = int(tag.attrib['gid'])
+    def parsexml(cls, tag):
+        '''Parse an <object> tag into a plain dict describing the object
+        (see fromdata()). Positions and dimensions are NOT SCALED.
+        '''
+        gid = tag.attrib.get('gid')
+        return dict(type=tag.attrib.get('type', 'rect'),
+                    name=tag.attrib.get('name'),
+                    x=int(tag.attrib['x']), y=int(tag.attrib['y']),
+                    width=int(tag.attrib.get('width', 0)),
+                    height=int(tag.attrib.get('height', 0)),
+                    gid=gid and int(gid),
+                    visible=int(tag.attrib.get('visible', 1)),
+                    properties=parse_properties(tag))
+
+    @classmethod
+    def fromdata(cls, data, map):
+        '''Create an Object from the dict produced by parsexml().
+        '''
+        gid = data['gid']
+        x = data['x'] * map.scale
+        if gid is not None:
             tile = map.tilesets[gid]
-            w = tile.tile_width
-            h = tile.tile_height
+            w = tile.scaled_tile_width
+            h = tile.scaled_tile_height
+            # tile objects are anchored at their bottom-left corner;
+            # __init__ moves y down by the tile height
+            y = map.scaled_height - data['y'] * map.scale + h
         else:
-            gid = None
             tile = None
-            w = int(tag.attrib['width']) * map.scale
-            h = int(tag.attrib['height']) * map.scale
-            x = int(tag.attrib['x']) * map.scale
-            y = map.scaled_height - h - int(tag.attrib['y']) * map.scale
-
-        o = cls(tag.attrib.get('type', 'rect'), x, y, w, h, tag.attrib.get('name'), gid, tile,
-                int(tag.attrib.get('visible', 1)))
-
-        props = tag.find('properties')
-        if props is None:
-            return o
+            w = data['width'] * map.scale
+            h = data['height'] * map.scale
+            y = map.scaled_height - h - data['y'] * map.scale
 
-        for c in props.findall('property'):
-            # store additional properties.
-            name = c.attrib['name']
-            value = c.attrib['value']
-
-            # TODO hax
-            if value.isdigit():
-                value = int(value)
-            o.properties[name] = value
+        o = cls(data['type'], x, y, w, h, data['name'], gid, tile,
+                data['visible'])
+        o.properties.update(data['properties'])
         return o
 
+    @classmethod
+    def fromxml(cls, tag, map):
+        return cls.fromdata(cls.parsexml(tag), map)
+
     def intersects(self, x1, y1, x2, y2):
         if x2 < self.px:
             return False
@@ -505,6 +2221,24 @@ class Object(object):
             return False
         return True
 
+    def contains(self, x, y):
+        return self.intersects(x, y, x, y)
+
+    def move_to(self, x, y):
+        '''Move the Object so its bottom-left corner is at (x, y).
+        '''
+        self.px = self.left = x
+        self.py = self.bottom = y
+        self.right = x + self.width
+        self.top = y + self.height
+        if self._layer is not None:
+            self._layer._moved(self)
+
+    def move(self, dx, dy):
+        '''Move the Object by (dx, dy).
+        '''
+        self.move_to(self.px + dx, self.py + dy)
+
 
 class ObjectLayer(object):
     '''A layer composed of basic primitive shapes.
@@ -520,7 +2254,25 @@ class ObjectLayer(object):
         opacity - the opacity of the layer as a value from 0 to 1.
         visible - whether the layer is shown (1) or hidden (0).
         objects - the objects in this Layer (Object instances)
+
+    The objects' properties are indexed (see build_index()) for find() and
+    match(); the index is kept up to date as their properties are changed.
+
+    The objects are also bucketed into a uniform grid (see build_grid())
+    so that get_in_region(), collide() and get_at() only look at the
+    objects near the region. Objects may be moved (see Object.move_to()),
+    added (see add()) and removed (see remove()) at any time; the grid is
+    "loose" so that an object moving within its bucket margin costs
+    nothing to track and only objects that leave it are rebucketed.
     '''
+
+    # how far (as a fraction of a bucket) an object's grid entry extends
+    # past its bounds
+    grid_margin = .5
+
+    # property name to bit in the objects' flags; see build_flags()
+    flag_bits = {}
+
     def __init__(self, name, color, objects, opacity=1,
                  visible=1, position=(0, 0)):
         self.name = name
@@ -530,6 +2282,8 @@ class ObjectLayer(object):
         self.visible = visible
         self.position = position
         self.properties = {}
+        self._grid = None
+        self.build_index()
 
     def __repr__(self):
         return '<ObjectLayer "%s" at 0x%x>' % (self.name, id(self))
@@ -538,12 +2292,11 @@ class ObjectLayer(object):
         return iter(self.objects)
 
     @classmethod
-    def fromxml(cls, tag, map):
-        layer = cls(tag.attrib['name'], tag.attrib.get('color'), [],
-                    float(tag.attrib.get('opacity', 1)),
-                    int(tag.attrib.get('visible', 1)))
-        for object in tag.findall('object'):
-            layer.objects.append(Object.fromxml(object, map))
+    def parsexml(cls, tag):
+        '''Parse an <objectgroup> tag into a plain dict describing the
+        layer and its objects (see fromdata()).
+        '''
+        properties = {}
         for c in tag.findall('property'):
             # store additional properties.
             name = c.attrib['name']
@@ -552,9 +2305,30 @@ class ObjectLayer(object):
             # TODO hax
             if value.isdigit():
                 value = int(value)
-            layer.properties[name] = value
+            properties[name] = value
+        return dict(name=tag.attrib['name'], color=tag.attrib.get('color'),
+                    opacity=float(tag.attrib.get('opacity', 1)),
+                    visible=int(tag.attrib.get('visible', 1)),
+                    properties=properties,
+                    objects=[Object.parsexml(object)
+                             for object in tag.findall('object')])
+
+    @classmethod
+    def fromdata(cls, data, map):
+        '''Create an ObjectLayer from the dict produced by parsexml().
+        '''
+        layer = cls(data['name'], data['color'],
+                    [Object.fromdata(object, map) for object in data['objects']],
+                    data['opacity'], data['visible'])
+        layer.properties.update(data['properties'])
+        layer.build_grid(map.scaled_tile_width, map.scaled_tile_height)
+        layer.build_flags(map.flag_bits)
         return layer
 
+    @classmethod
+    def fromxml(cls, tag, map):
+        return cls.fromdata(cls.parsexml(tag), map)
+
     def update(self, dt, *args):
         pass
 
@@ -565,14 +2339,141 @@ class ObjectLayer(object):
         y -= viewport_oy
         self.position = (x, y)
 
+    def build_index(self):
+        '''Build the index of object properties used by find() and match().
+
+        This is done when the ObjectLayer is created and need only be called
+        again if the objects list is changed directly.
+        '''
+        index = PropertyIndex()
+        self._order = {}
+        for n, object in enumerate(self.objects):
+            object._layer = self
+            self._order[object] = n
+            for name in object.keys():
+                index.add(object, name, object[name])
+        self._index = index
+        self._next_order = len(self.objects)
+
+    def build_flags(self, flag_bits):
+        '''Set the flags of the objects (see Object) for the properties
+        named in flag_bits, a dict of name to bit, so that collide() can
+        skip objects without the property by testing the bit. Layers loaded
+        from a map use the map's flag_properties.
+
+        The flags are kept up to date as the objects' properties change.
+        '''
+        self.flag_bits = flag_bits
+        for object in self.objects:
+            object.flags = _flags(object, flag_bits)
+
+    def build_grid(self, bucket_width, bucket_height):
+        '''Bucket the objects into a uniform grid of the given cell size,
+        for region queries. Layers loaded from a map use the map's tile
+        size.
+
+        Without a grid region queries test every object. This need only be
+        called again if the objects list is changed directly rather than
+        through add() and remove().
+        '''
+        self._bucket_size = bucket_width, bucket_height
+        self._grid = {}
+        self._spans = {}
+        for object in self.objects:
+            self._insert(object)
+
+    def _span(self, object, margin=0):
+        # the range of buckets covering the object, plus margin buckets
+        bw, bh = self._bucket_size
+        mx, my = bw * margin, bh * margin
+        return (int((object.px - mx) // bw), int((object.py - my) // bh),
+                int((object.px + object.width + mx) // bw),
+                int((object.py + object.height + my) // bh))
+
+    def _buckets(self, x1, y1, x2, y2):
+        bw, bh = self._bucket_size
+        j1, j2 = int(y1 // bh), int(y2 // bh)
+        for i in xrange(int(x1 // bw), int(x2 // bw) + 1):
+            for j in xrange(j1, j2 + 1):
+                yield i, j
+
+    def _insert(self, object):
+        span = self._spans[object] = self._span(object, self.grid_margin)
+        i1, j1, i2, j2 = span
+        for i in xrange(i1, i2 + 1):
+            for j in xrange(j1, j2 + 1):
+                self._grid.setdefault((i, j), []).append(object)
+
+    def _discard(self, object):
+        i1, j1, i2, j2 = self._spans.pop(object)
+        for i in xrange(i1, i2 + 1):
+            for j in xrange(j1, j2 + 1):
+                bucket = self._grid[i, j]
+                bucket.remove(object)
+                if not bucket:
+                    del self._grid[i, j]
+
+    def _moved(self, object):
+        # object has moved; only rebucket it if it left its loose span
+        if self._grid is None:
+            return
+        i1, j1, i2, j2 = self._span(object)
+        si1, sj1, si2, sj2 = self._spans[object]
+        if si1 <= i1 and sj1 <= j1 and i2 <= si2 and j2 <= sj2:
+            return
+        self._discard(object)
+        self._insert(object)
+
+    def add(self, object):
+        '''Add the Object to this layer, for collide(), find() and so on.
+        '''
+        self.objects.append(object)
+        object._layer = self
+        self._order[object] = self._next_order
+        self._next_order += 1
+        for name in object.keys():
+            self._index.add(object, name, object[name])
+        object.flags = _flags(object, self.flag_bits)
+        if self._grid is not None:
+            self._insert(object)
+
+    def remove(self, object):
+        '''Remove the Object from this layer.
+        '''
+        self.objects.remove(object)
+        if self._grid is not None:
+            self._discard(object)
+        for name in object.keys():
+            self._index.remove(object, name, object[name])
+        del self._order[object]
+        object._layer = None
+
+    def _unindex(self, object, key):
+        # object property key is about to change
+        if key in object:
+            self._index.remove(object, key, object[key])
+
+    def _reindex(self, object, key):
+        # object property key has changed
+        if key in object:
+            self._index.add(object, key, object[key])
+        bit = self.flag_bits.get(key)
+        if bit:
+            if key in object:
+                object.flags |= bit
+            else:
+                object.flags &= ~bit
+
     def find(self, *properties):
         '''Find all cells with the given properties set.
         '''
         r = []
         for propname in properties:
-            for object in self.objects:
-                if object and propname in object or propname in self.properties:
-                    r.append(object)
+            if propname in self.properties:
+                r.extend(self.objects)
+            else:
+                r.extend(sorted(self._index.named(propname),
+                                key=self._order.get))
         return r
 
     def match(self, **properties):
@@ -580,13 +2481,17 @@ class ObjectLayer(object):
         '''
         r = []
         for propname in properties:
+            if propname not in self.properties:
+                r.extend(sorted(self._index.valued(propname,
+                                                   properties[propname]),
+                                key=self._order.get))
+                continue
+            # objects without the property take the layer's value
             for object in self.objects:
                 if propname in object:
                     val = object[propname]
-                elif propname in self.properties:
-                    val = self.properties[propname]
                 else:
-                    continue
+                    val = self.properties[propname]
                 if properties[propname] == val:
                     r.append(object)
         return r
@@ -595,12 +2500,96 @@ class ObjectLayer(object):
         '''Find all objects the rect is touching that have the indicated
         property name set.
         '''
-        r = []
-        for object in self.get_in_region(rect.left, rect.bottom, rect.right,
-                                         rect.top):
-            if propname in object or propname in self.properties:
-                r.append(object)
-        return r
+        objects = self.get_in_region(rect.left, rect.bottom, rect.right,
+                                     rect.top)
+        if propname in self.properties:
+            return objects
+        bit = self.flag_bits.get(propname)
+        if bit:
+            return [object for object in objects if object.flags & bit]
+        return [object for object in objects if propname in object]
+
+    def collide_many(self, boxes, propname):
+        '''Find the objects touched by each of many boxes that have the
+        indicated property name set.
+
+        The boxes are a flat sequence (eg. an array('f')) of (left, bottom,
+        right, top). Return two arrays of equal length, each hit being the
+        index of the box in the sequence and the index of the object in the
+        objects list; the hits for each box are in the objects' order.
+        '''
+        hit_boxes, hit_objects = array.array('i'), array.array('i')
+        if propname in self.properties:
+            wanted = self.objects
+        else:
+            wanted = self._index.named(propname)
+        if not wanted:
+            return hit_boxes, hit_objects
+        position = dict((object, n) for n, object in enumerate(self.objects))
+        grid = self._grid
+        if grid is not None:
+            bw, bh = self._bucket_size
+        for n in xrange(len(boxes) // 4):
+            x1, y1, x2, y2 = boxes[n * 4:n * 4 + 4]
+            if grid is None or (x2 - x1) / float(bw) * (y2 - y1) / bh > len(wanted):
+                found = wanted
+            else:
+                found = set()
+                for key in self._buckets(x1, y1, x2, y2):
+                    found.update(grid.get(key, ()))
+                found.intersection_update(wanted)
+            hits = [position[object] for object in found
+                    if object.intersects(x1, y1, x2, y2)]
+            hits.sort()
+            hit_boxes.extend([n] * len(hits))
+            hit_objects.extend(hits)
+        return hit_boxes, hit_objects
+
+    def sweep(self, rect, dx, dy, propname):
+        '''Find the first object with the indicated property name set that
+        the rect hits when moved by (dx, dy), looking only at the objects
+        near the path.
+
+        If the property's value is made of the letters l, r, t and b (as
+        in the "blocker" property of the platformer) only those sides of
+        the object are hit; other values make all sides hit.
+
+        Return (t, (nx, ny), object, (rdx, rdy)) giving the fraction of the
+        motion made before the hit, the normal of the side of the object
+        hit, the object and the remaining motion, or None if nothing is hit.
+        '''
+        box = rect.left, rect.bottom, rect.right, rect.top
+        best = None
+        for object in self.get_in_region(min(box[0], box[0] + dx),
+                                         min(box[1], box[1] + dy),
+                                         max(box[2], box[2] + dx),
+                                         max(box[3], box[3] + dy)):
+            if propname in object:
+                value = object[propname]
+            elif propname in self.properties:
+                value = self.properties[propname]
+            else:
+                continue
+            hit = time_of_impact(box, dx, dy, (object.left, object.bottom,
+                                               object.right, object.top))
+            if hit is not None and (best is None or hit[0] < best[0]):
+                if _blocks(value, hit[1]):
+                    best = hit + (object,)
+        if best is None:
+            return None
+        t, normal, object = best
+        return t, normal, object, (dx * (1 - t), dy * (1 - t))
+
+    def slide(self, rect, dx, dy, propname, steps=3):
+        '''Move the rect (in place) by (dx, dy), stopping against the sides
+        of the objects with the indicated property name set (see sweep())
+        and sliding along them with the rest of the motion, for up to
+        "steps" contacts.
+
+        Return a list of the contacts as ((nx, ny), object) and the motion
+        left over if the steps ran out.
+        '''
+        return _slide(self, rect, dx, dy, propname, steps)
 
     def get_in_region(self, x1, y1, x2, y2):
         '''Return objects that are within the map-space
@@ -609,16 +2598,25 @@ class ObjectLayer(object):
 
         Return a list of Object instances.
         '''
-        return [obj for obj in self.objects if obj.intersects(x1, y1, x2, y2)]
+        if self._grid is None:
+            return [obj for obj in self.objects if obj.intersects(x1, y1, x2, y2)]
+        bw, bh = self._bucket_size
+        if (x2 - x1) / float(bw) * (y2 - y1) / bh > len(self.objects):
+            # cheaper to just test them all
+            return [obj for obj in self.objects if obj.intersects(x1, y1, x2, y2)]
+        found = set()
+        for key in self._buckets(x1, y1, x2, y2):
+            found.update(self._grid.get(key, ()))
+        return sorted((obj for obj in found if obj.intersects(x1, y1, x2, y2)),
+                      key=self._order.get)
 
     def get_at(self, x, y):
         '''Return the first object found at the nominated (x, y) coordinate.
 
         Return an Object instance or None.
         '''
-        for object in self.objects:
-            if object.contains(x, y):
-                return object
+        for object in self.get_in_region(x, y, x, y):
+            return object
 
 
 class SpriteLayer(object):
@@ -677,10 +2675,41 @@ class TileMap(object):
         view_x, view_y - viewport offset (origin)
         viewport - a Rect instance giving the current viewport specification
 
+    Maps loaded with paged=True keep their tile layers' gids in pages of
+    page_size by page_size cells, holding at most page_limit pages per layer
+    and always those covering the viewport plus page_margin cells.
+
+    The flag_properties (at most eight) are compiled into a bit each,
+    given by flag_bits, in the Layer flags grids and Object flags for fast
+    collision filtering.
+
+    The cells and objects with each of the merge_properties are merged into
+    as few rectangles as possible (see merge()) when the map is parsed,
+    and kept in the compiled map; any missing from a map compiled for other
+    merge_properties are merged when the map is built. These are found in
+    .merged, keyed by property name, as an ObjectLayer (not one of the
+    .layers) for collision testing: for example
+    map.merged['blocker'].slide(rect, dx, dy, 'blocker').
+
+    Maps created with atlas=True pack all their Tilesets into a TileAtlas,
+    found in .atlas.
+
+    The map's animated tiles are played by its TileAnimator, .animator.
     '''
 
-    def __init__(self, viewport_size, viewport_origin=(0, 0), scale=1):
+    page_size = 32
+    page_margin = 8
+    page_limit = 64
+    merge_properties = ('blocker',)
+    flag_properties = ('blocker',)
+
+    def __init__(self, viewport_size, viewport_origin=(0, 0), scale=1,
+                 compact=False, atlas=False):
         self.scale = scale
+        self.compact = compact
+        self.use_atlas = atlas
+        self.atlas = None
+        self.animator = None
         self.px_width = self.scaled_width = 0
         self.px_height = self.scaled_height = 0
         self.tile_width = self.scaled_tile_width = 0
@@ -690,45 +2719,441 @@ class TileMap(object):
         self.properties = {}
         self.layers = Layers()
         self.tilesets = Tilesets()
+        self.merged = {}
+        if len(self.flag_properties) > 8:
+            raise ValueError('at most 8 flag_properties may be compiled into '
+                             'the flags bytes, not %d: %r' % (
+                                 len(self.flag_properties),
+                                 self.flag_properties))
+        self.flag_bits = dict((name, 1 << n)
+                              for n, name in enumerate(self.flag_properties))
         self.fx, self.fy = 0, 0  # viewport focus point
         self.view_w, self.view_h = viewport_size  # viewport size
         self.view_x, self.view_y = viewport_origin  # viewport offset
         self.viewport = Rect(*(viewport_origin + viewport_size))
 
     @classmethod
-    def load(cls, filename, viewport, scale=1):
-        with open(filename) as f:
-            map = ElementTree.fromstring(f.read())
+    def load(cls, filename, viewport, scale=1, cache=True, compact=False,
+             paged=False, threads=0, atlas=False):
+        '''Load the TMX file and create a TileMap for it.
 
-        # get most general map information and create a surface
-        tilemap = cls(viewport, scale=scale)
-        tilemap.width = int(map.attrib['width'])
-        tilemap.height = int(map.attrib['height'])
-        tilemap.tile_width = int(map.attrib['tilewidth'])
-        tilemap.tile_height = int(map.attrib['tileheight'])
-        tilemap.px_width = tilemap.width * tilemap.tile_width
-        tilemap.px_height = tilemap.height * tilemap.tile_height
+        If cache is true the compiled form of the map (see tmxcache) is
+        used when it is up to date with the TMX file and otherwise written
+        out after the TMX file is parsed.
 
-        tilemap.file_path = os.path.dirname(filename)
+        If compact is true the Layers only store their gid arrays and create
+        Cells as they're looked up (see CellGrid.)
 
-        tilemap.scaled_width = tilemap.px_width * tilemap.scale
-        tilemap.scaled_height = tilemap.px_height * tilemap.scale
-        tilemap.scaled_tile_width = tilemap.tile_width * tilemap.scale
-        tilemap.scaled_tile_height = tilemap.tile_height * tilemap.scale
+        If paged is true the Layers' gids are read from the compiled map
+        in pages as the view moves (see PagedGids.) This requires the cache.
+
+        If threads is given the compressed layers are decoded in parallel
+        on a pool of that many threads (see parsexml().)
+
+        If atlas is true the map's Tilesets are packed into a TileAtlas.
+        '''
+        data = cls.loaddata(filename, cache, paged, threads=threads)
+        return cls.fromdata(data, filename, viewport, scale, compact, atlas)
 
-        for tag in map.findall('tileset'):
-            tilemap.tilesets.add(Tileset.fromxml(tag, tilemap))
+    @classmethod
+    def load_async(cls, filename, viewport, scale=1, on_load=None,
+                   on_progress=None, cache=True, compact=False, paged=False,
+                   threads=0, atlas=False, on_error=None):
+        '''Load the TMX file like load() without blocking the Kivy main
+        thread.
+
+        The file is read and decoded on a worker thread; the Tilesets (which
+        load textures) and Layers are then created on the main thread, a
+        slice of time each frame (see run_sliced()).
+
+        on_progress(fraction) is called on the main thread as the load
+        progresses, and on_load(tilemap) once the TileMap is complete.
+
+        If the map can't be loaded (the file is missing or corrupt, or a
+        tileset image can't be read) on_error(exception) is called on the
+        main thread; without an on_error the exception is re-raised there,
+        from a Clock callback.
+        '''
+        @mainthread
+        def progress(fraction):
+            if on_progress is not None:
+                on_progress(fraction)
+
+        @mainthread
+        def fail(exc):
+            if on_error is None:
+                raise exc
+            on_error(exc)
+
+        @mainthread
+        def build(data):
+            tilemap = cls(viewport, scale=scale, compact=compact, atlas=atlas)
+
+            def step(fraction):
+                if on_progress is not None:
+                    on_progress(.5 + fraction / 2.)
+
+            def done():
+                if on_load is not None:
+                    on_load(tilemap)
+
+            run_sliced(tilemap.build(data, filename), step, done, on_error)
+
+        def work():
+            try:
+                data = cls.loaddata(filename, cache, paged,
+                                    lambda fraction: progress(fraction / 2.),
+                                    threads)
+            except Exception as exc:
+                fail(exc)
+            else:
+                build(data)
+
+        worker = threading.Thread(target=work, name='TileMap.load_async')
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    @classmethod
+    def loaddata(cls, filename, cache=True, paged=False, progress=None,
+                 threads=0):
+        '''Return the plain description of the TMX file (see parsexml()),
+        from the compiled map if cache is true and it's up to date.
+        '''
+        data = tmxcache.load(filename, paged) if cache else None
+        if data is None:
+            # paged infinite maps go into the cache without ever being
+            # assembled into whole grids in memory
+            sparse = cache and paged
+            data = cls.parsexml(filename, progress, threads, sparse)
+            if cache:
+                tmxcache.save(filename, data)
+                if paged:
+                    paged_data = tmxcache.load(filename, paged)
+                    if paged_data is None:
+                        # couldn't write the cache
+                        cls._fill_chunks(data)
+                    else:
+                        data = paged_data
+        if progress is not None:
+            progress(1)
+        return data
+
+    @classmethod
+    def parsexml(cls, filename, progress=None, threads=0, sparse=False):
+        '''Parse the TMX file into a plain description of the map: a dict
+        holding the map dimensions and lists of "tilesets", "layers" and
+        "objectgroups" descriptions, plus the "sources" files the map was
+        read from.
+
+        The file is parsed incrementally: each <tileset>, <layer> and
+        <objectgroup> is decoded as soon as it has been read and then
+        discarded, so the whole document is never held in memory.
+
+        The chunks of infinite maps are placed in a fixed grid covering all
+        of them, with the top-left chunk at (0, 0), and assembled into the
+        layers' gids. If sparse is true the layers instead keep the
+        "chunks" ([x, y, width, height, gids] in the grid) for
+        tmxcache.save() to write out a row at a time, so the whole grid is
+        never held in memory. The tile data of fixed size maps is always
+        decoded whole, so those must fit in memory when first parsed.
+
+        The "merged" rectangles of the cells and objects with each of the
+        merge_properties (see merge()) are also worked out, in pixels from
+        the top-left of the map like the objects.
+
+        If given, progress(fraction) is called with the fraction of the file
+        read after each of those elements.
+
+        If threads is given the compressed layers (and chunks of infinite
+        maps) are decoded on a pool of that many threads while the file is
+        read, and put back in document order at the end. Only inflating
+        releases the GIL (base64 decoding, csv parsing and the gid arrays
+        don't) so this helps only maps with many or large compressed
+        layers, on more than one core.
+        '''
+        file_path = os.path.dirname(filename)
+        data = dict(sources=[filename], tilesets=[], layers=[],
+                    objectgroups=[])
+
+        pool = None
+        if threads:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(threads)
+        try:
+            with open(filename, 'rb') as f:
+                size = float(os.fstat(f.fileno()).st_size) or 1
+
+                def report():
+                    if progress is not None:
+                        progress(f.tell() / size)
+
+                cls._parse(f, file_path, data, report, pool)
+
+            # wait for the layers decoding on the pool
+            for layer in data['layers']:
+                if 'gids' in layer and callable(layer['gids']):
+                    layer['gids'] = layer['gids']()
+                for chunk in layer.get('chunks', []):
+                    if callable(chunk[4]):
+                        chunk[4] = chunk[4]()
+        finally:
+            if pool is not None:
+                pool.close()
+
+        if data['infinite']:
+            cls._assemble_chunks(data)
+            if not sparse:
+                cls._fill_chunks(data)
+        data['merged'] = dict((name, cls._merge_data(data, name))
+                              for name in cls.merge_properties)
+        return data
+
+    @staticmethod
+    def _parse(f, file_path, data, report, pool=None):
+        map = None
+        depth = 0
+        for event, tag in ElementTree.iterparse(f, ('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if map is None:
+                    map = tag
+                    data.update(width=int(map.attrib['width']),
+                                height=int(map.attrib['height']),
+                                tilewidth=int(map.attrib['tilewidth']),
+                                tileheight=int(map.attrib['tileheight']),
+                                infinite=int(map.attrib.get('infinite', 0)))
+                continue
 
-        for tag in map.findall('layer'):
-            layer = Layer.fromxml(tag, tilemap)
-            tilemap.layers.add_named(layer, layer.name)
+            # only interested in the direct children of <map>
+            depth -= 1
+            if depth != 1:
+                continue
 
-        for tag in map.findall('objectgroup'):
-            layer = ObjectLayer.fromxml(tag, tilemap)
-            tilemap.layers.add_named(layer, layer.name)
+            if tag.tag == 'tileset':
+                tileset = Tileset.parsexml(tag, file_path)
+                data['tilesets'].append(tileset)
+                if tileset['source']:
+                    data['sources'].append(tileset['source'])
+            elif tag.tag == 'layer':
+                data['layers'].append(Layer.parsexml(tag, pool))
+            elif tag.tag == 'objectgroup':
+                data['objectgroups'].append(ObjectLayer.parsexml(tag))
+            map.remove(tag)
+            report()
+
+    @staticmethod
+    def _assemble_chunks(data):
+        chunks = [chunk for layer in data['layers']
+                  for chunk in layer.get('chunks', [])]
+        if chunks:
+            x1 = min(x for x, y, w, h, gids in chunks)
+            y1 = min(y for x, y, w, h, gids in chunks)
+            x2 = max(x + w for x, y, w, h, gids in chunks)
+            y2 = max(y + h for x, y, w, h, gids in chunks)
+        else:
+            x1, y1, x2, y2 = 0, 0, data['width'], data['height']
+        data['width'] = x2 - x1
+        data['height'] = y2 - y1
+        for chunk in chunks:
+            chunk[0] -= x1
+            chunk[1] -= y1
+        for layer in data['layers']:
+            layer.pop('gids', None)
+            layer.setdefault('chunks', [])
+
+        # objects are positioned in pixels from the old origin
+        for layer in data['objectgroups']:
+            for object in layer['objects']:
+                object['x'] -= x1 * data['tilewidth']
+                object['y'] -= y1 * data['tileheight']
+
+    @staticmethod
+    def _fill_chunks(data):
+        # assemble the gids of layers held as chunks
+        for layer in data['layers']:
+            if 'chunks' in layer:
+                gids = layer['gids'] = array.array('I')
+                for row in tmxcache.chunk_rows(layer.pop('chunks'),
+                                               data['width'], data['height']):
+                    gids.extend(row)
+
+    @staticmethod
+    def _merge_data(data, propname):
+        # values of the property by gid
+        values = {}
+        for tileset in data['tilesets']:
+            for id, properties in tileset['tiles']:
+                if propname in properties:
+                    values[tileset['firstgid'] + id] = properties[propname]
+
+        def tile_size(gid):
+            size = None
+            for tileset in sorted(data['tilesets'],
+                                  key=lambda tileset: tileset['firstgid']):
+                if tileset['firstgid'] <= gid:
+                    size = tileset['tilewidth'], tileset['tileheight']
+            return size
+
+        tw, th = data['tilewidth'], data['tileheight']
+        boxes = []
+        if values:
+            for layer in data['layers']:
+                # the chunks are merged one by one, then with each other
+                chunks = layer.get('chunks')
+                if chunks is None:
+                    chunks = [(0, 0, data['width'], data['height'],
+                               layer['gids'])]
+                for x, y, cw, ch, gids in chunks:
+                    grid = [values.get(gid) for gid in gids]
+                    for i, j, w, h, value in mesh_grid(grid, cw, ch):
+                        boxes.append(((x + i) * tw, (y + j) * th,
+                                      w * tw, h * th, value))
+
+        for layer in data['objectgroups']:
+            for object in layer['objects']:
+                x, y = object['x'], object['y']
+                w, h = object['width'], object['height']
+                properties = dict(layer['properties'])
+                gid = object['gid']
+                if gid is not None:
+                    # tile objects are anchored at their bottom-left corner
+                    w, h = tile_size(gid)
+                    y -= h
+                    if gid in values:
+                        properties[propname] = values[gid]
+                properties.update(object['properties'])
+                if propname in properties:
+                    boxes.append((x, y, w, h, properties[propname]))
+        return merge_boxes(boxes)
+
+    def merge(self, propname):
+        '''Merge the cells and objects of all the layers which have the
+        indicated property name set into as few rectangles as possible,
+        joining neighbours with the same value for the property, and store
+        them as .merged[propname].
+
+        This is done for the merge_properties when the map is loaded, and
+        need only be done again if those cells or objects are changed.
+
+        Return the ObjectLayer holding the rectangles (as Objects with just
+        the property set).
+        '''
+        boxes = []
+        for layer in self.layers:
+            if isinstance(layer, Layer):
+                tw, th, w = layer.tile_width, layer.tile_height, layer.width
+                grid = [None] * (w * layer.height)
+                for k, flag in enumerate(layer.property_mask(propname)):
+                    if flag:
+                        grid[k] = layer.cells[k % w, k // w][propname]
+                for i, j, cw, ch, value in mesh_grid(grid, w, layer.height):
+                    # OpenGL vs. TMX, y is reversed
+                    boxes.append((i * tw, self.scaled_height - (j + ch) * th,
+                                  cw * tw, ch * th, value))
+            elif isinstance(layer, ObjectLayer):
+                for object in layer.objects:
+                    if propname in object:
+                        value = object[propname]
+                    elif propname in layer.properties:
+                        value = layer.properties[propname]
+                    else:
+                        continue
+                    boxes.append((object.px, object.py, object.width,
+                                  object.height, value))
+        return self._set_merged(propname, merge_boxes(boxes))
+
+    def _set_merged(self, propname, boxes):
+        objects = []
+        for x, y, w, h, value in boxes:
+            object = Object('merged', x, y, w, h)
+            object.properties[propname] = value
+            objects.append(object)
+        layer = ObjectLayer(propname, None, objects, visible=0)
+        layer.build_grid(self.scaled_tile_width, self.scaled_tile_height)
+        layer.build_flags(self.flag_bits)
+        self.merged[propname] = layer
+        return layer
 
+    @classmethod
+    def fromdata(cls, data, filename, viewport, scale=1, compact=False,
+                 atlas=False):
+        '''Create a TileMap from the description produced by parsexml().
+        '''
+        tilemap = cls(viewport, scale=scale, compact=compact, atlas=atlas)
+        for fraction in tilemap.build(data, filename):
+            pass
         return tilemap
 
+    def build(self, data, filename):
+        '''Populate this TileMap from the description produced by
+        parsexml().
+
+        This is a generator yielding the fraction of the work done after
+        each Tileset and layer is created.
+        '''
+        # get most general map information and create a surface
+        self.width = data['width']
+        self.height = data['height']
+        self.tile_width = data['tilewidth']
+        self.tile_height = data['tileheight']
+        self.px_width = self.width * self.tile_width
+        self.px_height = self.height * self.tile_height
+
+        self.file_path = os.path.dirname(filename)
+
+        self.scaled_width = self.px_width * self.scale
+        self.scaled_height = self.px_height * self.scale
+        self.scaled_tile_width = self.tile_width * self.scale
+        self.scaled_tile_height = self.tile_height * self.scale
+
+        total = float(len(data['tilesets']) + len(data['layers']) +
+                      len(data['objectgroups'])) or 1
+        done = 0
+
+        for tileset in data['tilesets']:
+            self.tilesets.add(Tileset.fromdata(tileset, self))
+            done += 1
+            yield done / total
+
+        if self.use_atlas:
+            self.atlas = TileAtlas(self.tilesets.sets, filename)
+        self.animator = TileAnimator(self.tilesets)
+
+        for layer in data['layers']:
+            layer = Layer.fromdata(layer, self)
+            self.layers.add_named(layer, layer.name)
+            done += 1
+            yield done / total
+
+        for layer in data['objectgroups']:
+            layer = ObjectLayer.fromdata(layer, self)
+            self.layers.add_named(layer, layer.name)
+            done += 1
+            yield done / total
+
+        for propname, boxes in data['merged'].items():
+            if propname not in self.merge_properties:
+                continue
+            # pixels from the top-left of the map, like the objects
+            s = self.scale
+            self._set_merged(propname, [
+                (x * s, self.scaled_height - (y + h) * s, w * s, h * s, value)
+                for x, y, w, h, value in boxes])
+        for propname in self.merge_properties:
+            if propname not in self.merged:
+                # the map was compiled for other merge_properties
+                self.merge(propname)
+
+    def release(self):
+        '''Release this map's tileset images back to the tileset_cache; call
+        when the map is no longer needed.
+        '''
+        for tileset in self.tilesets.sets:
+            tileset.release()
+        del self.tilesets.sets[:]
+        self.atlas = None
+
     def update(self, dt, *args):
         for layer in self.layers:
             layer.update(dt, *args)
@@ -822,6 +3247,41 @@ class TileMap(object):
         for layer in self.layers:
             layer.set_view(x, y, w, h, self.view_x, self.view_y)
 
+    def raycast(self, x, y, dx, dy, propname='blocker'):
+        '''Cast a ray from (x, y) to (x + dx, y + dy) in map space (y up, as
+        for the objects and viewport) through all the layers, until it hits
+        a cell (see Layer.raycast()) or object (see ObjectLayer.sweep())
+        with the indicated property name set.
+
+        Return (t, (nx, ny), item, (hx, hy)) giving the fraction of the way
+        along the ray, the normal of the side hit, the Cell or Object and
+        the point hit, or None if nothing was hit.
+        '''
+        best = None
+        for layer in self.layers:
+            if isinstance(layer, Layer):
+                # OpenGL vs. TMX, y is reversed
+                hit = layer.raycast(x, layer.px_height - y, dx, -dy, propname)
+                if hit is not None:
+                    t, (nx, ny), cell, (hx, hy) = hit
+                    hit = t, (nx, -ny), cell, (hx, layer.px_height - hy)
+            elif isinstance(layer, ObjectLayer):
+                hit = layer.sweep(Rect(x, y, 0, 0), dx, dy, propname)
+                if hit is not None:
+                    t, normal, object, rest = hit
+                    hit = t, normal, object, (x + dx * t, y + dy * t)
+            else:
+                continue
+            if hit is not None and (best is None or hit[0] < best[0]):
+                best = hit
+        return best
+
+    def line_of_sight(self, x1, y1, x2, y2, propname='blocker'):
+        '''Return whether nothing with the indicated property name set lies
+        between the map space points (x1, y1) and (x2, y2) (see raycast()).
+        '''
+        return self.raycast(x1, y1, x2 - x1, y2 - y1, propname) is None
+
     def pixel_from_screen(self, x, y):
         '''Look up the Layer-space pixel matching the screen-space pixel.
         '''
@@ -842,54 +3302,571 @@ class TileMap(object):
         return int(sx // self.tile_width), int(sy // self.tile_height)
 
 
-def load(filename, viewport, scale=1):
-    return TileMap.load(filename, viewport, scale)
+def load(filename, viewport, scale=1, cache=True, compact=False, paged=False,
+         threads=0, atlas=False):
+    return TileMap.load(filename, viewport, scale, cache, compact, paged,
+                        threads, atlas)
+
+
+def run_sliced(steps, on_step=None, on_done=None, on_error=None,
+               budget=1 / 120.):
+    '''Run the generator steps on the Kivy clock, for up to budget seconds
+    each frame, so that long jobs don't stall the UI.
+
+    on_step is called with each value yielded and on_done once the
+    generator is exhausted. If the generator raises an exception the job
+    stops and on_error(exception) is called, or without an on_error the
+    exception is re-raised.
+    '''
+    def tick(dt):
+        end = time.time() + budget
+        try:
+            for value in steps:
+                if on_step is not None:
+                    on_step(value)
+                if time.time() > end:
+                    Clock.schedule_once(tick)
+                    return
+        except Exception as exc:
+            if on_error is None:
+                raise
+            on_error(exc)
+            return
+        if on_done is not None:
+            on_done()
+    Clock.schedule_once(tick)
+
+
+class CulledLayerView(object):
+    '''Draws the cells of a Layer which are within the view, plus margin
+    cells around it, into an InstructionGroup.
+
+    As the view moves (see set_view()) Rectangles are added for the cells
+    coming into it and those of the cells leaving it are removed and kept
+    for reuse, so the instructions scale with the size of the view rather
+    than the size of the map. Cells changed in the Layer are redrawn, as are
+    the animated cells in view whose frame changes (see animate()).
+    '''
+
+    margin = 2
+
+    def __init__(self, layer, animator=None):
+        self.layer = layer
+        self.animator = animator
+        self.group = InstructionGroup()
+        self._rects = {}
+        # animated gid -> positions of the cells drawn with it
+        self._animated = {}
+        self._spare = []
+        self._range = None
+        self._version = layer.version
+
+    def __repr__(self):
+        return '<CulledLayerView for %r>' % self.layer
+
+    def set_view(self, x, y, w, h):
+        '''Draw the cells within the view at (x, y) of size (w, h), in
+        OpenGL (y up) pixels.
+        '''
+        layer = self.layer
+        tw, th, m = layer.tile_width, layer.tile_height, self.margin
+        # OpenGL vs. TMX, y is reversed
+        top = layer.px_height - (y + h)
+        new = (max(0, int(x // tw) - m), max(0, int(top // th) - m),
+               min(layer.width, int((x + w) // tw) + m + 1),
+               min(layer.height, int((top + h) // th) + m + 1))
+        changed = self._version != layer.version
+        if new == self._range and not changed:
+            return
+        old = self._range
+        self._range = new
+        self._version = layer.version
+        i1, j1, i2, j2 = new
+
+        # recycle the cells which have left the view
+        for pos in list(self._rects):
+            i, j = pos
+            if not (i1 <= i < i2 and j1 <= j < j2):
+                self._recycle(pos)
+
+        gids, width = layer.gids, layer.width
+        for j in xrange(j1, j2):
+            for i in xrange(i1, i2):
+                if (not changed and old is not None and
+                        old[0] <= i < old[2] and old[1] <= j < old[3]):
+                    continue
+                self._draw(i, j, gids[i + j * width])
+
+    def animate(self, changed):
+        '''Redraw the cells in view of the animated gids whose frame has
+        changed (see TileAnimator.update()).
+        '''
+        for gid in changed:
+            positions = self._animated.get(gid)
+            if positions:
+                texture = self.layer.tilesets[gid].texture
+                for pos in positions:
+                    self._rects[pos][0].texture = texture
+
+    def _recycle(self, pos):
+        rect, gid = self._rects.pop(pos)
+        self.group.remove(rect)
+        self._spare.append(rect)
+        if gid in self._animated:
+            self._animated[gid].discard(pos)
+
+    def _draw(self, i, j, gid):
+        current = self._rects.get((i, j))
+        if current is not None:
+            if current[1] == gid:
+                return
+            self._recycle((i, j))
+        if not gid:
+            return
+        layer = self.layer
+        tile = layer.tilesets[gid]
+        pos = (i * layer.tile_width,
+               layer.px_height - (j + 1) * layer.tile_height)
+        size = (tile.scaled_tile_width, tile.scaled_tile_height)
+        if self._spare:
+            rect = self._spare.pop()
+            rect.texture = tile.texture
+            rect.pos = pos
+            rect.size = size
+        else:
+            rect = Rectangle(pos=pos, size=size, texture=tile.texture)
+        self.group.add(rect)
+        self._rects[i, j] = rect, gid
+        if self.animator is not None and gid in self.animator.frames:
+            self._animated.setdefault(gid, set()).add((i, j))
+
+
+class ChunkedLayerView(object):
+    '''Draws the cells of a Layer in chunks of size by size cells, each a
+    single Mesh per texture used in it (one for all the Tilesets of a map
+    packed into a TileAtlas page), into an InstructionGroup.
+
+    A chunk's Mesh is made, when the chunk first comes into view (see
+    set_view()), from the Layer's gids and the Tilesets' uvs. Only the
+    chunks in view are in the InstructionGroup. Chunks are made again only
+    if their gids (or the Layer's scaled tile size) have changed.
+
+    The uvs of animated cells are changed in place as their frame changes
+    (see animate()), in the chunks in view.
+    '''
+
+    size = 16
+
+    def __init__(self, layer, animator=None):
+        self.layer = layer
+        self.animator = animator
+        self.group = InstructionGroup()
+        # key -> (group, stamp, {animated gid: [(Mesh, vertices, offset)]})
+        self._chunks = {}
+        # animated gid -> keys of the chunks drawing it
+        self._animated = {}
+        self._shown = set()
+        self._range = None
+        self._version = layer.version
+        self._uvs = {}
+
+    def __repr__(self):
+        return '<ChunkedLayerView for %r>' % self.layer
+
+    def set_view(self, x, y, w, h):
+        '''Draw the chunks within the view at (x, y) of size (w, h), in
+        OpenGL (y up) pixels.
+        '''
+        layer = self.layer
+        cw = layer.tile_width * self.size
+        ch = layer.tile_height * self.size
+        # OpenGL vs. TMX, y is reversed
+        top = layer.px_height - (y + h)
+        new = (max(0, int(x // cw)), max(0, int(top // ch)),
+               min(-(-layer.width // self.size), int((x + w) // cw) + 1),
+               min(-(-layer.height // self.size), int((top + h) // ch) + 1))
+        changed = self._version != layer.version
+        if new == self._range and not changed:
+            return
+        self._range = new
+        self._version = layer.version
+        i1, j1, i2, j2 = new
+        wanted = set((ci, cj) for ci in xrange(i1, i2)
+                     for cj in xrange(j1, j2))
+        for key in self._shown - wanted:
+            self.group.remove(self._chunks[key][0])
+        for key in wanted:
+            if changed or key not in self._shown:
+                self._show(key)
+        self._shown = wanted
+
+    def _gids(self, key):
+        # the gids of the chunk, row by row
+        layer, size = self.layer, self.size
+        ci, cj = key
+        i1, i2 = ci * size, min(layer.width, (ci + 1) * size)
+        gids = layer.gids
+        chunk = array.array('I')
+        for j in xrange(cj * size, min(layer.height, (cj + 1) * size)):
+            start = j * layer.width
+            if isinstance(gids, PagedGids):
+                chunk.extend([gids[k] for k in xrange(start + i1, start + i2)])
+            else:
+                chunk.extend(gids[start + i1:start + i2])
+        return chunk
+
+    def _show(self, key):
+        gids = self._gids(key)
+        stamp = gids, self.layer.tile_width, self.layer.tile_height
+        chunk = self._chunks.get(key)
+        if chunk is not None and chunk[1] == stamp:
+            if key not in self._shown:
+                self.group.add(chunk[0])
+                if chunk[2]:
+                    # catch up with the frames shown while out of view
+                    self._animate(chunk[2], chunk[2])
+            return
+        if chunk is not None:
+            if key in self._shown:
+                self.group.remove(chunk[0])
+            for gid in chunk[2]:
+                self._animated[gid].discard(key)
+        group, animated = self._build(key, gids)
+        self._chunks[key] = group, stamp, animated
+        for gid in animated:
+            self._animated.setdefault(gid, set()).add(key)
+        self.group.add(group)
+
+    def animate(self, changed):
+        '''Change the uvs of the cells in view of the animated gids whose
+        frame has changed (see TileAnimator.update()).
+        '''
+        for gid in changed:
+            for key in self._animated.get(gid, ()):
+                if key in self._shown:
+                    self._animate(self._chunks[key][2], (gid,))
+
+    def _animate(self, animated, gids):
+        # show the current frame of the gids in a chunk's Meshes
+        frames, meshes = self.animator.frames, {}
+        for gid in gids:
+            frame = frames[gid]
+            tileset = self.layer.tilesets.tileset_for(frame)
+            uv = (frame - tileset.firstgid) * 4
+            u1, v1, u2, v2 = self._tile_uvs(tileset)[uv:uv + 4]
+            for mesh, vertices, offset in animated[gid]:
+                vertices[offset + 2:offset + 4] = [u1, v1]
+                vertices[offset + 6:offset + 8] = [u2, v1]
+                vertices[offset + 10:offset + 12] = [u2, v2]
+                vertices[offset + 14:offset + 16] = [u1, v2]
+                meshes[mesh] = vertices
+        for mesh, vertices in meshes.items():
+            mesh.vertices = vertices
+
+    def _tile_uvs(self, tileset):
+        # the tileset's uvs within its texture's region of the image
+        uvs = self._uvs.get(tileset)
+        if uvs is None:
+            (u, v), (us, vs) = tileset.texture.uvpos, tileset.texture.uvsize
+            uvs = self._uvs[tileset] = array.array('f', [
+                u + value * us if n % 2 == 0 else v + value * vs
+                for n, value in enumerate(tileset.uvs)])
+        return uvs
+
+    def _build(self, key, gids):
+        layer, size = self.layer, self.size
+        ci, cj = key
+        width = min(layer.width, (ci + 1) * size) - ci * size
+        tw, th = layer.tile_width, layer.tile_height
+        frames = self.animator.frames if self.animator is not None else {}
+        tilesets = {}
+        # texture -> (vertices, indices)
+        meshes = {}
+        # animated gid -> [(texture, offset in vertices)]
+        animated = {}
+        for n, gid in enumerate(gids):
+            if not gid:
+                continue
+            tileset = tilesets.get(gid)
+            if tileset is None:
+                tileset = tilesets[gid] = layer.tilesets.tileset_for(gid)
+            vertices, indices = meshes.setdefault(tileset.texture, ([], []))
+            if gid in frames:
+                animated.setdefault(gid, []).append((tileset.texture,
+                                                     len(vertices)))
+                # frames are of the same tileset
+                gid = frames[gid]
+            i = ci * size + n % width
+            j = cj * size + n // width
+            x1 = i * tw
+            y1 = layer.px_height - (j + 1) * th
+            x2 = x1 + tileset.scaled_tile_width
+            y2 = y1 + tileset.scaled_tile_height
+            uv = (gid - tileset.firstgid) * 4
+            u1, v1, u2, v2 = self._tile_uvs(tileset)[uv:uv + 4]
+            b = len(vertices) // 4
+            vertices.extend((x1, y1, u1, v1, x2, y1, u2, v1,
+                             x2, y2, u2, v2, x1, y2, u1, v2))
+            indices.extend((b, b + 1, b + 2, b + 2, b + 3, b))
+        group = InstructionGroup()
+        # texture -> (Mesh, vertices)
+        built = {}
+        for texture, (vertices, indices) in meshes.items():
+            mesh = Mesh(vertices=vertices, indices=indices, mode='triangles',
+                        texture=texture)
+            built[texture] = mesh, vertices
+            group.add(mesh)
+        for gid, cells in animated.items():
+            animated[gid] = [built[texture] + (offset,)
+                             for texture, offset in cells]
+        return group, animated
+
+
+class BakedLayerView(ChunkedLayerView):
+    '''Draws the cells of a Layer which doesn't change (or seldom does) in
+    chunks like ChunkedLayerView, but with each chunk's Meshes drawn just
+    once into a texture (through an Fbo), so a chunk in view is a single
+    textured Rectangle.
+
+    A chunk is drawn again only if its cells are changed or the Layer's
+    scaled tile size changes, or (while in view) as its animated cells
+    change frame.
+    '''
+
+    def __repr__(self):
+        return '<BakedLayerView for %r>' % self.layer
+
+    def _build(self, key, gids):
+        # the Fbo is in the group (ahead of the Rectangle showing its
+        # texture) so that it's redrawn if the GL context is lost; it only
+        # draws its Meshes when they change
+        layer, size = self.layer, self.size
+        ci, cj = key
+        columns = min(layer.width, (ci + 1) * size) - ci * size
+        rows = min(layer.height, (cj + 1) * size) - cj * size
+        # the bottom-left of the chunk, OpenGL vs. TMX y reversed
+        x = ci * size * layer.tile_width
+        y = layer.px_height - (cj * size + rows) * layer.tile_height
+        w, h = columns * layer.tile_width, rows * layer.tile_height
+
+        fbo = Fbo(size=(int(round(w)), int(round(h))))
+        with fbo:
+            ClearColor(0, 0, 0, 0)
+            ClearBuffers()
+            Translate(-x, -y)
+        meshes, animated = ChunkedLayerView._build(self, key, gids)
+        fbo.add(meshes)
+        fbo.texture.mag_filter = 'nearest'
+
+        group = InstructionGroup()
+        group.add(fbo)
+        group.add(Rectangle(pos=(x, y), size=(w, h), texture=fbo.texture))
+        return group, animated
 
 
 class TileMapWidget(Widget):
-    def __init__(self, filename, viewport, scale):
+    '''Display a TileMap, loaded from the TMX filename.
+
+    If background is true the map is loaded without blocking (see
+    TileMap.load_async()) and the widget's canvas is filled in over a number
+    of frames. The map attribute is None until the on_load event fires, and
+    on_progress(fraction) events are fired as the loading progresses.
+
+    The render argument chooses how the tile layers are drawn:
+
+        'full' - a Rectangle for every cell, made when the map is loaded
+        'culled' - Rectangles for just the cells in (or near) the viewport,
+                   kept up to date as it moves (see CulledLayerView)
+        'chunked' - a Mesh per texture for each chunk of cells in the
+                    viewport (see ChunkedLayerView)
+
+    The tile layers named in bake (which should seldom change, such as
+    backgrounds) are drawn, whatever the render mode, as chunks baked into
+    textures (see BakedLayerView).
+
+    The map's animated tiles are played, every frame, by its TileAnimator.
+
+    Additional keyword arguments are passed on to TileMap.load() (or
+    TileMap.load_async(), such as on_error, when loading in the background).
+    '''
+    __events__ = ('on_progress', 'on_load')
+
+    map = None
+
+    # the view translation and the viewport origin it was set for
+    _translate = None
+    _origin = None
+
+    # the Clock event playing the map's animated tiles
+    _animation = None
+
+    # the views drawing tile layers, by render mode
+    layer_views = {'culled': CulledLayerView, 'chunked': ChunkedLayerView}
+
+    def __init__(self, filename, viewport, scale, background=False,
+                 render='full', bake=(), **options):
         super(TileMapWidget, self).__init__()
-        self.map = TileMap.load(filename, viewport, scale)
+        self.render = render
+        self.bake = bake
+        self.views = []
+        # animated gid -> the Rectangles drawn with it outside of the views
+        self._animated = {}
+        # the map's instructions, ahead of any child widgets
+        self._group = InstructionGroup()
+        self.canvas.add(self._group)
+        self.load(filename, viewport, scale, background, **options)
+
+    def load(self, filename, viewport, scale, background=False, **options):
+        '''Load and display the TMX filename in place of the current map,
+        which is released (see release()) once the new map is loaded.
+        '''
+        if background:
+            TileMap.load_async(filename, viewport, scale,
+                               on_load=self._loaded,
+                               on_progress=lambda fraction: self.dispatch(
+                                   'on_progress', fraction * .8),
+                               **options)
+            return
+        map = TileMap.load(filename, viewport, scale, **options)
+        self.release()
+        self.map = map
+        for fraction in self.draw():
+            pass
+        self.set_focus(0, 0)
+
+    def release(self):
+        '''Stop displaying the map and release it (see TileMap.release()).
+        '''
+        if self.map is None:
+            return
+        if self._animation is not None:
+            self._animation.cancel()
+            self._animation = None
+        self._group.clear()
+        self._origin = None
+        self.views = []
+        self._animated = {}
+        self.map.release()
+        self.map = None
+
+    def _loaded(self, map):
+        self.release()
+        self.map = map
+
+        def done():
+            self.set_focus(0, 0)
+            self.dispatch('on_load')
+
+        run_sliced(self.draw(),
+                   lambda fraction: self.dispatch('on_progress',
+                                                  .8 + fraction * .2),
+                   done)
+
+    def on_progress(self, fraction):
+        pass
+
+    def on_load(self):
+        pass
+
+    def draw(self):
+        '''Add the instructions to draw the map to the canvas.
+
+        This is a generator yielding the fraction of the work done after
+        each row of cells.
+        '''
         self.size = (self.map.px_width, self.map.px_height)
-        with self.canvas:
-            for layer in self.map.layers:
-                if hasattr(layer, 'color') and layer.color:
-                    c = get_color_from_hex(layer.color)
-                    c[-1] = .2
-                    Color(*c)
+        layers = [layer for layer in self.map.layers if layer.visible]
+        total = float(len(layers)) or 1
+        add = self._group.add
+        if self.map.atlas is not None:
+            add(self.map.atlas.group)
+        for layer in self.map.layers:
+            if hasattr(layer, 'color') and layer.color:
+                c = get_color_from_hex(layer.color)
+                c[-1] = .2
+                add(Color(*c))
+            else:
+                add(Color(1, 1, 1))
+            if not layer.visible:
+                continue
+            done = layers.index(layer)
+            view = None
+            if isinstance(layer, Layer):
+                if layer.name in self.bake:
+                    view = BakedLayerView
                 else:
-                    Color(1, 1, 1)
-                if not layer.visible:
+                    view = self.layer_views.get(self.render)
+            if view is not None:
+                view = view(layer, self.map.animator)
+                self.views.append(view)
+                add(view.group)
+                yield (done + 1) / total
+                continue
+            if isinstance(layer, Layer):
+                row, count = layer.width, float(layer.width * layer.height)
+            else:
+                row, count = 64, float(len(layer.objects))
+            for n, cell in enumerate(layer):
+                if n % row == row - 1:
+                    yield (done + n / count) / total
+                if cell is None:
                     continue
-                for cell in layer:
-                    if cell is None:
-                        continue
+                if isinstance(cell, Object):
+                    # objects are already positioned y up
+                    texture = cell.tile and cell.tile.texture
+                    rect = Rectangle(pos=(cell.px, cell.py), texture=texture,
+                                     size=(cell.width, cell.height))
+                else:
                     x = cell.px
                     # OpenGL vs. TMX, y is reversed
                     y = self.map.scaled_height - cell.py - self.map.scaled_tile_height
-                    if cell.tile:
-                        texture = cell.tile.texture
-                        size = cell.px_width, cell.px_height
-                        Rectangle(pos=(x, y), texture=texture, size=size, allow_stretch=True)
-                    else:
-                        Rectangle(pos=(cell.px, cell.py), size=(cell.width, cell.height))
-        self.set_focus(0, 0)
+                    texture = cell.tile.texture
+                    size = cell.px_width, cell.px_height
+                    rect = Rectangle(pos=(x, y), texture=texture, size=size, allow_stretch=True)
+                add(rect)
+                if cell.tile and cell.tile.gid in self.map.animator.frames:
+                    self._animated.setdefault(cell.tile.gid, []).append(rect)
+            yield (done + 1) / total
+        if self.map.animator.animations:
+            self._animation = Clock.schedule_interval(self._animate, 0)
+
+    def _animate(self, dt):
+        changed = self.map.animator.update(dt)
+        if not changed:
+            return
+        for gid in changed:
+            texture = self.map.tilesets[gid].texture
+            for rect in self._animated.get(gid, ()):
+                rect.texture = texture
+        for view in self.views:
+            view.animate(changed)
 
     def set_focus(self, x, y):
+        if self.map is None:
+            return
         self.map.set_focus(x, y)
         self._set_view()
 
     def force_focus(self, x, y):
+        if self.map is None:
+            return
         self.map.force_focus(x, y)
         self._set_view()
 
     def _set_view(self):
-        fx, fy = self.map.viewport.origin
-        # clear any previous before/after instructions
-        self.canvas.before.clear()
-        self.canvas.after.clear()
-        with self.canvas.before:
-            PushMatrix('projection_mat')
-            Translate(-fx, -fy)
-        with self.canvas.after:
-            PopMatrix('projection_mat')
+        viewport = self.map.viewport
+        for view in self.views:
+            view.set_view(viewport.x, viewport.y, viewport.width,
+                          viewport.height)
+        origin = tuple(viewport.origin)
+        if origin == self._origin:
+            return
+        self._origin = origin
+        if self._translate is None:
+            with self.canvas.before:
+                PushMatrix('projection_mat')
+                self._translate = Translate()
+            with self.canvas.after:
+                PopMatrix('projection_mat')
+        fx, fy = origin
+        self._translate.xy = (-fx, -fy)
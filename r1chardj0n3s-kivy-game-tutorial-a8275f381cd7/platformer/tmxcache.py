@@ -0,0 +1,296 @@
+# Compiled binary cache for "Tiled" TMX maps
+# This code is placed in the Public Domain.
+
+'''A compiled form of a TMX map, written next to the source map the first
+time it is loaded (platformer.tmx -> platformer.tmxc) so that subsequent
+loads need no XML parsing, base64 decoding or zlib inflation.
+
+The cache holds the plain map description produced by TileMap.parsexml():
+the map and tileset metadata and the object layers are stored as a JSON
+block while the gid grid of each tile layer is stored as raw little-endian
+unsigned 32-bit integers. The file layout is:
+
+    offset 0   magic b'TMXC'
+    offset 4   format version (uint32)
+    offset 8   length of the JSON metadata in bytes (uint32)
+    offset 12  JSON metadata (UTF-8)
+    ...        padding to a 4 byte boundary
+    ...        gid grids, in the order of the metadata "layers" list; each
+               layer records its "offset" (from the start of the file) and
+               "count" (number of gids)
+
+The grids are read straight out of a memory map of the file into arrays,
+or for paged maps left in the memory map and read a region at a time
+through a GidFile. Layers of infinite maps may be saved from their chunks,
+which are written out a row at a time (see chunk_rows()).
+
+The cache is keyed off the modification time and size of the TMX file and
+any external tilesets (.tsx) it references; if any of those change the
+cache is ignored and rewritten.
+
+Both files are written to a temporary file next to the map and renamed
+into place once complete, so an interrupted write leaves either the old
+file or none; a cache that is short or unreadable anyway is ignored.
+
+The layout of a map's TileAtlas, if it has one, is kept as JSON in a
+separate file (platformer.tmx -> platformer.tmxa), keyed off the tilesets
+packed and the modification time and size of their images.
+'''
+
+import os
+import sys
+import json
+import mmap
+import array
+import struct
+import tempfile
+import collections
+
+MAGIC = b'TMXC'
+VERSION = 4
+
+_header = struct.Struct('<4sII')
+
+
+def cache_filename(filename):
+    '''Return the name of the compiled cache file for the TMX filename.
+    '''
+    return filename + 'c'
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [path, st.st_mtime, st.st_size]
+
+
+def _is_current(sources):
+    for path, mtime, size in sources:
+        try:
+            if _stamp(path) != [path, mtime, size]:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _gid_array(buf):
+    gids = array.array('I', buf)
+    if sys.byteorder == 'big':
+        gids.byteswap()
+    return gids
+
+
+def _gid_bytes(gids):
+    if sys.byteorder == 'big':
+        gids = array.array(gids.typecode, gids)
+        gids.byteswap()
+    if hasattr(gids, 'tobytes'):
+        return gids.tobytes()
+    return gids.tostring()
+
+
+def chunk_rows(chunks, width, height):
+    '''Generate the gids of each row of the width by height grid made up of
+    the chunks ([x, y, width, height, gids] in the grid) of an infinite
+    map's layer. Cells in no chunk are 0.
+    '''
+    rows = collections.defaultdict(list)
+    for x, y, w, h, gids in chunks:
+        for row in xrange(h):
+            rows[y + row].append((x, w, row * w, gids))
+    blank = array.array('I', [0]) * width
+    for j in xrange(height):
+        row = array.array('I', blank)
+        for x, w, start, gids in rows.pop(j, ()):
+            row[x:x + w] = gids[start:start + w]
+        yield row
+
+
+class GidFile(object):
+    '''A layer's gid grid left in the memory mapped compiled map.
+    '''
+
+    def __init__(self, mm, offset, width, height):
+        self.mm = mm
+        self.offset = offset
+        self.width = width
+        self.height = height
+
+    def __len__(self):
+        return self.width * self.height
+
+    def read(self, x, y, w, h):
+        '''Return the gids of the w by h cells from (x, y) in row order.
+        Cells outside the grid are 0.
+        '''
+        gids = array.array('I', [0]) * (w * h)
+        x1, x2 = max(x, 0), min(x + w, self.width)
+        if x1 >= x2:
+            return gids
+        for row in xrange(max(y, 0), min(y + h, self.height)):
+            start = self.offset + (row * self.width + x1) * 4
+            i = (row - y) * w + x1 - x
+            gids[i:i + x2 - x1] = _gid_array(self.mm[start:start + (x2 - x1) * 4])
+        return gids
+
+
+def load(filename, mapped=False):
+    '''Load the compiled form of the TMX filename.
+
+    Return the map description (see TileMap.parsexml()) or None if there
+    is no cache or it is out of date. If mapped is true the layer gids are
+    GidFile instances rather than arrays.
+    '''
+    path = cache_filename(filename)
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            return None
+        data = None
+        try:
+            data = _read(mm, mapped)
+        except (ValueError, KeyError):
+            # not a cache this version wrote (or wrote completely)
+            data = None
+        finally:
+            if data is None or not mapped:
+                mm.close()
+    return data
+
+
+def _read(mm, mapped):
+    if len(mm) < _header.size:
+        return None
+    magic, version, meta_len = _header.unpack(mm[:_header.size])
+    if magic != MAGIC or version != VERSION:
+        return None
+    start = _header.size
+    if start + meta_len > len(mm):
+        return None
+    data = json.loads(mm[start:start + meta_len].decode('utf-8'))
+    if not _is_current(data['sources']):
+        return None
+    for layer in data['layers']:
+        offset = layer.pop('offset')
+        count = layer.pop('count')
+        if offset + count * 4 > len(mm):
+            return None
+        if mapped:
+            layer['gids'] = GidFile(mm, offset, data['width'], data['height'])
+        else:
+            layer['gids'] = _gid_array(mm[offset:offset + count * 4])
+    return data
+
+
+def save(filename, data):
+    '''Write the map description (see TileMap.parsexml()) in compiled form
+    for the TMX filename. Layers may hold "chunks" rather than "gids".
+
+    Failure to write the cache (eg. a read-only install) is not an error.
+    '''
+    data = dict(data)
+    data['sources'] = [_stamp(path) for path in data['sources']]
+    sources = data['layers']
+    count = data['width'] * data['height']
+
+    # lay out the grids after the metadata; the metadata has to know the
+    # grid offsets though, so size it first with placeholder offsets
+    layers = [dict(layer, offset=0, count=count) for layer in sources]
+    for layer in layers:
+        layer.pop('gids', None)
+        layer.pop('chunks', None)
+    data['layers'] = layers
+
+    while True:
+        meta = json.dumps(data).encode('utf-8')
+        offset = _header.size + len(meta)
+        offset += -offset % 4
+        changed = False
+        for layer in layers:
+            if layer['offset'] != offset:
+                layer['offset'] = offset
+                changed = True
+            offset += count * 4
+        if not changed:
+            break
+
+    def write(f):
+        f.write(_header.pack(MAGIC, VERSION, len(meta)))
+        f.write(meta)
+        f.write(b'\0' * (-f.tell() % 4))
+        for layer in sources:
+            if 'chunks' in layer:
+                for row in chunk_rows(layer['chunks'], data['width'],
+                                      data['height']):
+                    f.write(_gid_bytes(row))
+            else:
+                f.write(_gid_bytes(layer['gids']))
+    _write(cache_filename(filename), write)
+
+
+def _write(path, write):
+    '''Call write() with a file opened for binary writing and move what it
+    wrote to path once it is complete. If anything fails path is left as
+    it was.
+    '''
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                   dir=os.path.dirname(path) or '.')
+    except (IOError, OSError):
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Windows won't rename over an existing file
+            if not os.path.exists(path):
+                raise
+            os.remove(path)
+            os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def atlas_filename(filename):
+    '''Return the name of the atlas layout file for the TMX filename.
+    '''
+    return filename + 'a'
+
+
+def load_atlas(filename, key):
+    '''Return the atlas layout (see tmx.TileAtlas.layout()) saved for the
+    TMX filename, or None if there is none for the key or the images have
+    changed.
+    '''
+    try:
+        with open(atlas_filename(filename)) as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if (saved.get('version') != VERSION or
+            saved.get('key') != json.loads(json.dumps(key)) or
+            not _is_current(saved['sources'])):
+        return None
+    return saved['layout']
+
+
+def save_atlas(filename, key, layout, images):
+    '''Write the atlas layout for the TMX filename, made for the key from
+    the image files.
+
+    Failure to write the layout is not an error.
+    '''
+    saved = dict(version=VERSION, key=key, layout=layout,
+                 sources=[_stamp(path) for path in images])
+    meta = json.dumps(saved).encode('utf-8')
+    _write(atlas_filename(filename), lambda f: f.write(meta))